@@ -1,3 +1,4 @@
+import gc
 import logging
 from logging.config import dictConfig
 
@@ -50,6 +51,9 @@ def create_app():
         'JSONIFY_PRETTYPRINT_REGULAR': False,
     })
 
+    # Exclude objects created at startup from later GC scans
+    gc.freeze()
+
     return app
 
 
@@ -1,32 +1,48 @@
+import collections
+import concurrent.futures
 import contextlib
-import copy
 import datetime
 import functools
 import gc
 import glob
+import io
+import itertools
 import json
 from logging import getLogger
 import os
-import random
+import re
 import resource
 import tempfile
+from typing import IO, Tuple, Union
 import zipfile
 
 from flask import Blueprint, jsonify, request, Response, send_file
 import laspy
 import numpy as np
 import open3d as o3d
+import orjson
 import psutil
+import scipy.spatial
 import shapely
+import shapely.wkb
 
 from .database import db
+from .pointcloud import voxel_down_sample
 from .zukaku import get_extent_polygon
 from .build3d import Build3d
 
 logger = getLogger(__name__)
 
 api = Blueprint('api', __name__, url_prefix='/api')
-random.seed()
+
+# 点数の上限の書式（例： "10k", "1M", "5000"）と単位
+LIMIT_PATTERN = re.compile(r'^\s*([+-]?\d+)([kKmM]?)\s*$')
+LIMIT_UNITS = {'': 1, 'k': 1000, 'm': 1000000}
+
+# GeoJSON Feature を出力するためのテンプレート
+FEATURE_PREFIX = b'{"type":"Feature","geometry":'
+FEATURE_MID = b',"properties":'
+FEATURE_SUFFIX = b'}'
 
 
 @contextlib.contextmanager
@@ -67,9 +83,47 @@ def check_memory_usage():
     logger.info("使用メモリ： {:.3f} MB".format(mem_used))
 
 
+def collect_garbage(function):
+    """
+    使用メモリがしきい値以上であれば gc を実行する
+
+    Parameters
+    ----------
+    function: callable
+        実行を終えた関数（ログ出力用）
+
+    Notes
+    -----
+    しきい値は環境変数 GC_THRESHOLD (バイト) で指定する。
+    省略時は 512MB。
+    """
+    process = psutil.Process(os.getpid())
+    mem_used0 = process.memory_info()[0] / float(2 ** 20)
+    threshold = os.environ.get('GC_THRESHOLD', 512 << 20)
+    threshold = int(threshold) / float(2 ** 20)
+    if mem_used0 < threshold:
+        logger.debug((
+            "関数 '{}' 実行後の使用メモリ {:.3f} MB が"
+            "しきい値 {:.3f} MB 未満のため GC を省略").format(
+                function, mem_used0, threshold))
+    else:
+        logger.info("関数 '{}' 実行後の GC:".format(function))
+        gc.collect(generation=2)
+        mem_used1 = process.memory_info()[0] / float(2 ** 20)
+        logger.info(
+            "使用メモリ： {:.3f} MB(GC前) -> {:.3f} MB(GC後)".format(
+                mem_used0, mem_used1))
+
+
 def gc_final(function):
     """
-    関数実行終了時に必ず gc を実行するデコレータ
+    関数実行終了時に、使用メモリがしきい値以上であれば
+    gc を実行するデコレータ
+
+    Notes
+    -----
+    ジェネレータを返す関数では、 Response の送信前に実行されるため、
+    ジェネレータの中で collect_garbage() を呼ぶこと。
     """
     @functools.wraps(function)
     def wrapper(*args, **kwargs):
@@ -77,17 +131,72 @@ def gc_final(function):
             result = function(*args, **kwargs)
             return result
         finally:
-            logger.info("関数 '{}' 実行後の GC:".format(function))
-            process = psutil.Process(os.getpid())
-            mem_used0 = process.memory_info()[0] / float(2 ** 20)
-            gc.collect()
-            mem_used1 = process.memory_info()[0] / float(2 ** 20)
-            logger.info("使用メモリ： {:.3f} MB(GC前) -> {:.3f} MB(GC後)".format(
-                mem_used0, mem_used1))
+            collect_garbage(function)
 
     return wrapper
 
 
+def parse_limit(limit: str) -> int:
+    """
+    点数の上限を表す文字列を整数に変換する。
+
+    Parameters
+    ----------
+    limit: str
+        点数の上限、末尾に k (千) または m (百万) を付けられる
+        （例： "10k", "1M", "5000"）
+
+    Returns
+    -------
+    int
+        点数の上限
+
+    Raises
+    ------
+    ValueError
+        書式が正しくない場合
+    """
+    m = LIMIT_PATTERN.match(limit)
+    if m is None:
+        raise ValueError("Invalid limit: '{}'".format(limit))
+
+    return int(m.group(1)) * LIMIT_UNITS[m.group(2).lower()]
+
+
+def create_zipfile(file: Union[os.PathLike, IO[bytes]], dirname: os.PathLike):
+    """
+    ディレクトリ内のファイルをまとめた ZIP ファイルを作成する。
+
+    Parameters
+    ----------
+    file: os.PathLike or file-like object
+        作成する ZIP ファイルのパス、または書き込み先のバイナリストリーム
+    dirname: os.PathLike
+        格納するファイルを含むディレクトリのパス
+
+    Notes
+    -----
+    テキスト形式の OBJ, MTL ファイルは最速の設定で圧縮し、
+    圧縮済みの PNG 画像などは圧縮せずに格納する。
+    """
+    with zipfile.ZipFile(
+            file, 'w', compression=zipfile.ZIP_STORED) as zipf:
+        for filename in glob.glob(os.path.join(dirname, '*')):
+            if os.path.isdir(filename):
+                continue
+
+            if filename.endswith(('.obj', '.mtl')):
+                compress_type = zipfile.ZIP_DEFLATED
+            else:
+                compress_type = zipfile.ZIP_STORED
+
+            zipf.write(
+                filename,
+                arcname=os.path.basename(filename),
+                compress_type=compress_type,
+                compresslevel=1)
+
+
 @api.route('/building2d', methods=['POST'])
 def building2d() -> str:
     """
@@ -127,7 +236,8 @@ def building2d() -> str:
     else:
         return jsonify(f"Invalid geojson type, {geojson_type}"), 400
 
-    return Response(match_features_generator(features))
+    return Response(
+        match_features_generator(features), mimetype='application/json')
 
 
 def match_features_generator(features: list, size: int = 4096):
@@ -143,74 +253,43 @@ def match_features_generator(features: list, size: int = 4096):
     size: int
         分割するサイズ
     """
-    yield '{"type":"FeatureCollection","features":['
+    yield b'{"type":"FeatureCollection","features":['
 
     assigned = set()
-
-    for n in range(0, len(features), size):
-        # テーブルを生成
-        # ToDo: 本来は temporary table が望ましい
-        tablename = "tmp_features_{:05d}".format(random.randrange(100000))
-        logger.debug("GeoJSON ({}:{}) をテーブル {} に登録開始".format(
-            n, n + size, tablename))
-        gdf = db.create_table(
-            tablename=tablename,
-            features=features[n: n + size]
-        )
-
-        logger.debug("Plateau テーブルと空間結合開始")
-        results = db.join_table_with_plateau(tablename=tablename)
-
-        for i, row in enumerate(results):
-            # GeoJSON 表現の Polygon を読み込み
-            # 頂点座標列を反時計回りに並べ替え
-            r = dict(row)
-            polygon = shapely.geometry.shape(json.loads(r["plateau_geom"]))
-            polygon = shapely.geometry.polygon.orient(polygon, sign=1.0)
-
-            confidence = "low"
-            if r["is_overlapped"]:
-                confidence = "high"
-                assigned.add(r["plateau_bldid"])
-            elif r["plateau_bldid"] in assigned:
-                continue
-
-            # Properties を生成
-            properties = {}
-            for k, v in r.items():
-                if k in ('__area', '__geom',
-                         'plateau_geom', 'geometry', 'is_overlapped'):
-                    continue
-                elif k in ('plateau_area', 'source_area', 'intersection_area'):
-                    v = round(v, 4)
-                elif k in ('dist', 'area_ratio'):
-                    v = round(v, 2)
-
-                properties[k] = v
-
-            properties['confidence'] = confidence  # 末尾に追加
-
-            # Feature を生成
-            feature = {
-                "type": "Feature",
-                "geometry": shapely.geometry.mapping(polygon),
-                "properties": properties
-            }
-            if n + i == 0:
-                yield "\n"
-            else:
-                yield ",\n"
-
-            yield json.dumps(feature, ensure_ascii=False)
-
-        # テーブルを削除
-        with db.get_session() as session:
-            session.execute(f"DROP TABLE {tablename}")
-            logger.debug("テーブル {} を削除".format(tablename))
-            session.commit()
-
-    yield "]}"
-    logger.debug("マッチング完了（{} features）".format(n + i))
+    separator = b"\n"  # 2件目以降は ",\n" で区切る
+    nfeatures = 0
+
+    with db.engine.connect() as connection:
+        for n in range(0, len(features), size):
+            # コネクションを再利用し、バッチごとにトランザクションを分ける
+            with connection.begin():
+                db.prepare_match_tables(connection)
+                logger.debug("GeoJSON ({}:{}) を一時テーブルに登録開始".format(
+                    n, n + size))
+                db.create_temp_features(
+                    connection=connection,
+                    features=features[n: n + size])
+
+                logger.debug("Plateau テーブルと空間結合開始")
+                results = db.join_table_with_plateau(connection=connection)
+
+                for bldid, is_overlapped, feature in results:
+                    if is_overlapped:
+                        assigned.add(bldid)
+                    elif bldid in assigned:
+                        # 既に確度 high でマッチした建物は出力しない
+                        continue
+
+                    yield separator
+                    yield feature.encode('utf-8')
+                    separator = b",\n"
+                    nfeatures += 1
+
+                # カーソルを閉じ、コミットして一時テーブルを空にする
+                results.close()
+
+    yield b"]}"
+    logger.debug("マッチング完了（{} features）".format(nfeatures))
 
 
 @api.route('/search-plateau', methods=['GET'])
@@ -354,14 +433,7 @@ def crop_las(bldid: str):
     limit = request.args.get("limit", "10k")
 
     try:
-        if limit is not None:
-            if limit.lower().endswith('k'):
-                limit = int(limit[:-1]) * 1000
-            elif limit.lower().endswith('m'):
-                limit = int(limit[:-1]) * 1000000
-            else:
-                limit = int(limit)
-
+        limit = parse_limit(limit)
     except ValueError as e:
         return str(e), 400
 
@@ -412,14 +484,7 @@ def get_obj3d(bldid: str):
         lod = 1
 
     try:
-        if limit is not None:
-            if limit.lower().endswith('k'):
-                limit = int(limit[:-1]) * 1000
-            elif limit.lower().endswith('m'):
-                limit = int(limit[:-1]) * 1000000
-            else:
-                limit = int(limit)
-
+        limit = parse_limit(limit)
     except ValueError as e:
         return str(e), 400
 
@@ -456,21 +521,11 @@ def get_obj3d(bldid: str):
             finally:
                 del build3d
 
-        # ZIP ファイルを作成
+        # ZIP ファイルをメモリ上に作成
         logger.debug("Zipfile を作成")
-        zipfilename = os.path.join(tmpdirname, '{}.zip'.format(bldid))
-        with zipfile.ZipFile(zipfilename, 'w') as zipf:
-            for filename in glob.glob(
-                    os.path.join(tmpdirname, '*')):
-                if os.path.isdir(filename):
-                    continue
-
-                if filename.endswith('.zip'):
-                    continue
-
-                zipf.write(
-                    filename,
-                    arcname=os.path.basename(filename))
+        zipbuf = io.BytesIO()
+        create_zipfile(zipbuf, tmpdirname)
+        zipbuf.seek(0)
 
         logger.info("処理時間：{:.3f} sec.".format(
             (datetime.datetime.now() - start_at).total_seconds()))
@@ -479,14 +534,104 @@ def get_obj3d(bldid: str):
             bldid, lod, method, imagesize, npoints)
 
         return send_file(
-            zipfilename,
+            zipbuf,
             as_attachment=True,
             download_name=download_name,
             mimetype='application/zip')
 
 
+def match_building_with_pointcloud(
+        r: dict,
+        pcd: o3d.geometry.PointCloud,
+        tree: scipy.spatial.cKDTree,
+        srid: int) -> Tuple[bytes, dict]:
+    """
+    Plateau 建物と三次元点群をマッチングし、 Feature を作成する。
+
+    Parameters
+    ----------
+    r: dict
+        search_plateau_intersects_polygon() が返す Plateau レコード
+    pcd: o3d.geometry.PointCloud
+        三次元点群（読み取りのみ、複数スレッドで共有する）
+    tree: scipy.spatial.cKDTree
+        pcd の X, Y 座標から作成した KD 木
+    srid: int
+        三次元点群の座標系
+
+    Returns
+    -------
+    (bytes, dict)
+        GeoJSON Feature の JSON と、処理ごとの経過時間（秒）
+    """
+    logger.info("bldid:{} の一致率を計算中".format(
+        r["plateau_bldid"]))
+    at0 = datetime.datetime.now()
+    build3d = Build3d(
+        bldid=r["plateau_bldid"],
+        system_code=srid - 6668,
+        lod=2)
+    build3d.set_pointcloud(build3d.crop_point_cloud(pcd, tree=tree))
+    logger.debug("bldid:{} の点群を切り出し完了".format(
+        r["plateau_bldid"]))
+    at1 = datetime.datetime.now()
+    npoints_in_region = len(build3d.pcd.points)
+    # 建物単位で並列実行しているため、 KD 木の探索は 1 スレッドで行う
+    npoints_near_wall = build3d.count_points_near_walls(
+        threshold=1.0, workers=1)
+    area = round(build3d.get_surface_area(), 2)
+    logger.debug("bldid:{} の壁面とのマッチング完了".format(
+        r["plateau_bldid"]))
+    at2 = datetime.datetime.now()
+
+    # WKB 表現の Polygon を読み込み
+    # 頂点座標列は DB 側で反時計回りに並べ替え済み
+    polygon = shapely.wkb.loads(bytes(r["plateau_geom"]))
+
+    # Feature の JSON を生成
+    properties = {
+        "plateau_bldid": r["plateau_bldid"],
+        "num_points_in_region": npoints_in_region,
+        "num_points_near_wall": npoints_near_wall,
+        "area": area,
+    }
+    feature = b"".join((
+        FEATURE_PREFIX,
+        orjson.dumps(shapely.geometry.mapping(polygon)),
+        FEATURE_MID,
+        orjson.dumps(properties),
+        FEATURE_SUFFIX))
+    logger.debug("bldid:{} の GeoJSON 生成完了".format(
+        r["plateau_bldid"]))
+    at3 = datetime.datetime.now()
+
+    elasp = {
+        "crop": (at1 - at0).total_seconds(),
+        "matching": (at2 - at1).total_seconds(),
+        "jsonify": (at3 - at2).total_seconds(),
+    }
+    return feature, elasp
+
+
+def try_match_building_with_pointcloud(r: dict, **kwargs) -> tuple:
+    """
+    match_building_with_pointcloud() を実行し、
+    例外が発生した場合はログに出力して (None, None) を返す。
+
+    Notes
+    -----
+    ストリーミング出力中に例外が発生すると、 ステータス 200 のまま
+    FeatureCollection が途中で切れてしまうため、建物単位でスキップする。
+    """
+    try:
+        return match_building_with_pointcloud(r, **kwargs)
+    except Exception:
+        logger.exception("bldid:{} のマッチングに失敗したためスキップします".format(
+            r["plateau_bldid"]))
+        return None, None
+
+
 @api.route('/pointcloud3d', methods=['POST'])
-@gc_final
 def check_las() -> str:
     """
     アップロードされた LAS ファイルに含まれる
@@ -537,13 +682,20 @@ def check_las() -> str:
             boundary = (hmins[0], hmins[1], hmaxs[0], hmaxs[1])
 
             # 1m 間隔の point cloud を作成
+            # 整数値の座標 X, Y, Z にスケールとオフセットを適用し、
+            # 確保済みの配列に直接書き込む
             las = fh.read()
-            las_nparray = np.stack((las.x, las.y, las.z), axis=-1)
+            npoints = len(las.points)
+            las_nparray = np.empty((npoints, 3), dtype=np.float64)
+            for i, values in enumerate((las.X, las.Y, las.Z)):
+                np.multiply(
+                    values, fh.header.scales[i], out=las_nparray[:, i])
+                las_nparray[:, i] += fh.header.offsets[i]
+
             pcd = o3d.geometry.PointCloud()
-            pcd.points = o3d.utility.Vector3dVector(las_nparray)
-            npoints = len(pcd.points)
-            pcd = pcd.voxel_down_sample(voxel_size=1.0)
-            del las
+            pcd.points = o3d.utility.Vector3dVector(
+                voxel_down_sample(las_nparray, voxel_size=1.0))
+            del las, las_nparray
 
         logger.info("LAS データを読み込み完了 ({} points)".format(npoints))
 
@@ -565,63 +717,96 @@ def check_las() -> str:
     logger.info("範囲内に {} 件の Plateau 建物があります。".format(
         len(results)))
 
-    # マッチング結果を FeatureCollection に変換
-    features = []
+    # 建物ごとの切り出しに使う KD 木を作成
+    tree = scipy.spatial.cKDTree(np.asarray(pcd.points)[:, 0:2])
+
+    return Response(
+        match_pointcloud_generator(
+            results=results, pcd=pcd, tree=tree, srid=srid,
+            start_at=start_at),
+        mimetype='application/json')
+
+
+def match_pointcloud_generator(
+        results: list,
+        pcd: o3d.geometry.PointCloud,
+        tree: scipy.spatial.cKDTree,
+        srid: int,
+        start_at: datetime.datetime):
+    """
+    Plateau 建物ごとに三次元点群とマッチングした結果を
+    FeatureCollection として Response にストリーミング出力する
+    ジェネレータ。
+
+    Parameters
+    ----------
+    results: list
+        search_plateau_intersects_polygon() が返す Plateau レコードのリスト
+    pcd: o3d.geometry.PointCloud
+        三次元点群
+    tree: scipy.spatial.cKDTree
+        pcd の X, Y 座標から作成した KD 木
+    srid: int
+        三次元点群の座標系
+    start_at: datetime.datetime
+        処理開始時刻
+
+    Notes
+    -----
+    処理はレスポンスの送信中に行われるため、
+    GC と処理時間のログ出力もジェネレータの終了時に行う。
+    クライアントが切断した場合は、未着手の建物を取り消す。
+    """
     elasps = {"crop": 0.0, "matching": 0.0, "jsonify": 0.0}
-    for r in results:
-        logger.info("bldid:{} の一致率を計算中".format(
-            r["plateau_bldid"]))
-        at0 = datetime.datetime.now()
-        build3d = Build3d(
-            bldid=r["plateau_bldid"],
-            system_code=srid - 6668,
-            lod=2)
-        build3d.pcd = build3d.crop_point_cloud(copy.copy(pcd))
-        logger.debug("bldid:{} の点群を切り出し完了".format(
-            r["plateau_bldid"]))
-        at1 = datetime.datetime.now()
-        elasps["crop"] += (at1 - at0).total_seconds()
-        npoints_in_region = len(build3d.pcd.points)
-        npoints_near_wall = build3d.count_points_near_walls(threshold=1.0)
-        area = round(build3d.get_surface_area(), 2)
-        logger.debug("bldid:{} の壁面とのマッチング完了".format(
-            r["plateau_bldid"]))
-        at2 = datetime.datetime.now()
-        elasps["matching"] += (at2 - at1).total_seconds()
-
-        # GeoJSON 表現の Polygon を読み込み
-        # 頂点座標列を反時計回りに並べ替え
-        polygon = shapely.geometry.shape(json.loads(r["plateau_geom"]))
-        polygon = shapely.geometry.polygon.orient(polygon, sign=1.0)
-
-        # Feature を生成
-        feature = {
-            "type": "Feature",
-            "geometry": shapely.geometry.mapping(polygon),
-            "properties": {
-                "plateau_bldid": r["plateau_bldid"],
-                "num_points_in_region": npoints_in_region,
-                "num_points_near_wall": npoints_near_wall,
-                "area": area,
-            },
-        }
-        features.append(feature)
-        logger.debug("bldid:{} の GeoJSON 生成完了".format(
-            r["plateau_bldid"]))
-        at3 = datetime.datetime.now()
-        elasps["jsonify"] += (at3 - at2).total_seconds()
+    max_workers = os.environ.get('MAX_WORKERS', os.cpu_count() or 1)
+    max_workers = int(max_workers)
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=max_workers)
+    futures = collections.deque()  # 投入済みで未出力の建物
+    try:
+        yield b'{"type":"FeatureCollection","features":['
+
+        # 建物ごとのマッチングを並列に実行し、
+        # 入力順に Feature を出力
+        # 投入する建物はワーカー数の 2 倍までに抑え、
+        # 1 件出力するごとに次の建物を投入する
+        match = functools.partial(
+            try_match_building_with_pointcloud,
+            pcd=pcd, tree=tree, srid=srid)
+        records = iter(results)
+        for r in itertools.islice(records, max_workers * 2):
+            futures.append(executor.submit(match, r))
+
+        separator = b"\n"  # 2件目以降は ",\n" で区切る
+        while futures:
+            feature, elasp = futures.popleft().result()
+            for r in itertools.islice(records, 1):
+                futures.append(executor.submit(match, r))
+
+            if feature is None:
+                continue
 
-    feature_collection = {
-        "type": "FeatureCollection",
-        "features": features,
-    }
-    logger.info("総切り出し時間：{:.3f}".format(elasps["crop"]))
-    logger.info("総マッチング時間：{:.3f}".format(elasps["matching"]))
-    logger.info("総 JSON 化時間：{:.3f}".format(elasps["jsonify"]))
-    logger.info("処理時間：{:.3f} sec.".format(
-        (datetime.datetime.now() - start_at).total_seconds()))
+            yield separator
+            yield feature
+            separator = b",\n"
+            for k, v in elasp.items():
+                elasps[k] += v
 
-    return jsonify(feature_collection), 200
+        yield b"]}"
+    finally:
+        # Python 3.8 では shutdown(cancel_futures=True) が使えないため、
+        # 未着手の建物は個別に取り消す
+        for future in futures:
+            future.cancel()
+
+        executor.shutdown(wait=True)
+        logger.info("総切り出し時間：{:.3f}".format(elasps["crop"]))
+        logger.info("総マッチング時間：{:.3f}".format(elasps["matching"]))
+        logger.info("総 JSON 化時間：{:.3f}".format(elasps["jsonify"]))
+        logger.info("処理時間：{:.3f} sec.".format(
+            (datetime.datetime.now() - start_at).total_seconds()))
+        del results, pcd, tree  # GC 前に参照を外す
+        collect_garbage(match_pointcloud_generator)
 
 
 @api.route('/mapping3d', methods=['POST'])
@@ -686,14 +871,7 @@ def match_las() -> str:
         lod = 1
 
     try:
-        if limit is not None:
-            if limit.lower().endswith('k'):
-                limit = int(limit[:-1]) * 1000
-            elif limit.lower().endswith('m'):
-                limit = int(limit[:-1]) * 1000000
-            else:
-                limit = int(limit)
-
+        limit = parse_limit(limit)
     except ValueError as e:
         return str(e), 400
 
@@ -737,21 +915,11 @@ def match_las() -> str:
             finally:
                 del build3d
 
-        # ZIP ファイルを作成
+        # ZIP ファイルをメモリ上に作成
         logger.debug("Zipfile を作成")
-        zipfilename = os.path.join(tmpdirname, '{}.zip'.format(bldid))
-        with zipfile.ZipFile(zipfilename, 'w') as zipf:
-            for filename in glob.glob(
-                    os.path.join(tmpdirname, '*')):
-                if os.path.isdir(filename):
-                    continue
-
-                if filename.endswith('.zip'):
-                    continue
-
-                zipf.write(
-                    filename,
-                    arcname=os.path.basename(filename))
+        zipbuf = io.BytesIO()
+        create_zipfile(zipbuf, tmpdirname)
+        zipbuf.seek(0)
 
         logger.info("処理時間：{:.3f} sec.".format(
             (datetime.datetime.now() - start_at).total_seconds()))
@@ -760,7 +928,7 @@ def match_las() -> str:
             bldid, lod, method, imagesize, npoints)
 
         return send_file(
-            zipfilename,
+            zipbuf,
             as_attachment=True,
             download_name=download_name,
             mimetype='application/zip')
@@ -8,6 +8,24 @@ from . import __version__
 
 app = Blueprint('app', __name__, url_prefix='/')
 
+
+def load_readme_html() -> str:
+    """
+    WebAPI.md を HTML に変換して返す。
+    ファイルが存在しない場合は 'README' を返す。
+    """
+    path = Path(__file__).parent.parent / "WebAPI.md"
+    try:
+        with open(path, encoding='utf-8') as f:
+            return markdown.markdown(f.read())
+    except FileNotFoundError:
+        return 'README'
+
+
+# 起動時に一度だけ変換しておく
+README_HTML = load_readme_html()
+
+
 @app.context_processor
 def inject_versions():
     return {
@@ -28,10 +46,6 @@ def match3d():
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
 def index(path):
-    readme_html = 'README'
-    with open(Path(__name__).parent / "WebAPI.md") as f:
-        readme_html = markdown.markdown(f.read())
-
     return render_template(
         'index.html',
-        readme_html=readme_html)
+        readme_html=README_HTML)
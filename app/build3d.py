@@ -1,5 +1,6 @@
 # build3d.py
-import copy
+import concurrent.futures
+import itertools
 from logging import getLogger
 import os
 import sys
@@ -9,6 +10,8 @@ import numpy as np
 import open3d as o3d
 from PIL import Image
 import scipy
+import scipy.ndimage
+import scipy.spatial
 import shapely
 
 from app.database import db
@@ -18,11 +21,60 @@ from app.zukaku import get_codes_in_area
 logger = getLogger(__name__)
 
 
+def calc_distances(
+        projected_points: np.ndarray,
+        boundary,
+        check_bounds: bool = True,
+        out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    面に射影した点群から、面との距離を計算する。
+
+    Parameters
+    ----------
+    projected_points: numpy.ndarray(..., 3)
+        面の座標系に射影した点群
+    boundary: array-like
+        面の X,Y 境界 [minx, miny, maxx, maxy]
+        (nsurfaces, npoints, 3) の点群をまとめて計算する場合は
+        各値が (nsurfaces, 1) の配列
+    check_bounds: bool
+        面の範囲外になる点に対して、
+        ペナルティとして距離 999.9 を加算する。
+    out: numpy.ndarray, optional
+        結果を書き込む float32 の配列
+
+    Returns
+    -------
+    numpy.ndarray
+        面との距離（絶対値）、 projected_points の最後の次元を除いた形
+
+    Notes
+    -----
+    複数の面の範囲外判定はブロードキャストで一度に行う。
+    一時配列を増やさないよう、比較と加算は出力先を指定して行う。
+    """
+    x = projected_points[..., 0]
+    y = projected_points[..., 1]
+    distances = np.fabs(projected_points[..., 2], out=out, dtype=np.float32)
+    if not check_bounds:
+        return distances
+
+    minx, miny, maxx, maxy = boundary
+    outbound_mask = np.less(x, minx)
+    work = np.empty_like(outbound_mask)
+    outbound_mask |= np.greater(x, maxx, out=work)
+    outbound_mask |= np.less(y, miny, out=work)
+    outbound_mask |= np.greater(y, maxy, out=work)
+    np.add(distances, np.float32(999.9), out=distances, where=outbound_mask)
+    return distances
+
+
 class Build3d(object):
 
     BUFFER = 1.0     # 切り出す際のバッファ（メートル）
     GRIDSIZE = 0.01  # 最高解像度のグリッドサイズ（メートル）
     LIMIT_POINTS = 500000  # 三次元点群の最大点数（0以下で無制限）
+    DISTANCE_BLOCK = 8  # 点群との距離をまとめて計算する面の数
 
     def __init__(
             self,
@@ -61,7 +113,11 @@ class Build3d(object):
         # 計算して取得する値
         self.building = None  # 建物オブジェクト: GeoDataFrame
         self.pcd = None       # 三次元点群: PointCloud
+        self.points = None    # 三次元点群の座標: ndarray(npoints, 3)
+        self.points_origin = None  # self.points の座標の原点
+        self.colors = None    # 三次元点群の色: ndarray(npoints, 3)
         self.distance_matrix = None  # 点と各面との距離
+        self.surfaces = None  # 面のリスト: List[Surface]
         self.gridsize = self.GRIDSIZE  # 三次元点群のグリッドサイズ
 
     def set_dirname(self, dirname: os.PathLike) -> bool:
@@ -144,7 +200,7 @@ class Build3d(object):
         building = self.get_building()
         nfaces = len(building)
         faces = [building.iloc[i].geom for i in range(nfaces)]
-        texture_images = [None] * nfaces
+        masks = [True] * nfaces  # 各面のテクスチャ画像に使う点
         prefix = "{}_lod{}_{}_{}_{}".format(
             self.bldid, self.lod,
             texture_mapping_method, imagesize,
@@ -154,29 +210,26 @@ class Build3d(object):
 
         # face[i] は building の i 番目の面
         # shapely.geometry.polygon.Polygon オブジェクト
-        # 1 番目の面の 0..1 の辺と 0..-1 の辺を取得する
-        face_vertices = []
-        all_vertices = []
-        surfaces = []
-        for i, face in enumerate(faces):
-            ring = face.exterior.coords
-            logger.debug("面{}には{}個の頂点があります".format(
-                i, len(ring)))
-            vertices = []
-            for v in ring[:-1]:
-                try:
-                    pos = all_vertices.index(v)
-                except ValueError:
-                    pos = len(all_vertices)
-                    all_vertices.append(v)
-
-                vertices.append(pos)
-
-            face_vertices.append(vertices)
-
-            # 面に投影する行列を計算
-            surface = Surface(i, build3d=self)
-            surfaces.append(surface)
+        # 全ての面の頂点をまとめて重複を除き、
+        # 各面の頂点を重複除去後の頂点の番号で表す
+        rings = [np.asarray(face.exterior.coords)[:-1] for face in faces]
+        sizes = [len(ring) for ring in rings]
+        logger.debug("各面の頂点数: {}".format(sizes))
+        all_vertices, first_index, inverse = np.unique(
+            np.concatenate(rings), axis=0,
+            return_index=True, return_inverse=True)
+
+        # np.unique はソート順になるので、初出順に並べ直す
+        order = np.argsort(first_index)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        all_vertices = all_vertices[order].tolist()
+        face_vertices = [
+            vertices.tolist() for vertices in np.split(
+                rank[inverse.ravel()], np.cumsum(sizes)[:-1])]
+
+        # 面に投影する行列を計算
+        surfaces = self.get_surfaces()
 
         if texture_mapping_method.lower() == "all":
             """
@@ -184,46 +237,45 @@ class Build3d(object):
             背面の点も正面にマッピングされる。
             """
             logger.info("テクスチャ画像作成開始（method:all）")
-            for n, surface in enumerate(surfaces):
-                mask = True
-                texture_images[n] = surface.create_texture_image(
-                    prefix=prefix, mask=mask, imagesize=imagesize,
-                    write_pointcloud=False)
 
         else:
             # 各面と点群の距離
-            logger.info("点群と各面({})との距離を計算".format(nfaces))
-            list_of_distances = []
-            k = 0  # distance_matrix の行数
-            nkmap = []  # 面n の距離リストが含まれる行番号
-            for n, surface in enumerate(surfaces):
-                distances = surface.get_distance_matrix(check_bounds=True)
+            # lod = 1 の時, 上面と底面には投影しないので距離も計算しない
+            targets = [
+                n for n in range(nfaces)
+                if not (self.lod == 1 and (n == 0 or n == nfaces - 1))]
+            logger.info("点群と各面({})との距離を計算".format(len(targets)))
+            # 距離が 10m 以内の面は投影結果を保持し、
+            # 深さの範囲とテクスチャ画像の作成で再利用する
+            all_distances = self.get_distance_matrix(
+                [surfaces[n] for n in targets], check_bounds=True,
+                keep_threshold=10.0)
+            rows = []  # distance_matrix に残す all_distances の行
+            nkmap = [None] * nfaces  # 面n の距離リストが含まれる行番号
+            for row, n in enumerate(targets):
+                distances = all_distances[row]
                 if len(distances) == 0:
                     # この建物に含まれる点群データがない場合
-                    nkmap.append(None)
                     continue
 
-                if self.lod == 1 and (n == 0 or n == len(surfaces) - 1):
-                    # lod = 1 の時, 上面と底面には投影しない
-                    distances = distances + 999.9
-
                 min_dist = distances.min()
                 logger.debug("- {}/{}, min_dist={:.3f}".format(
                     n + 1, nfaces, min_dist))
                 if min_dist > 10.0:
                     # 面n に最も近い点が 10m 離れているので
                     # マッピング対象外とする
-                    nkmap.append(None)
                     continue
 
-                list_of_distances.append(distances)
+                nkmap[n] = len(rows)
+                rows.append(row)
 
-                nkmap.append(k)
-                k += 1
+            if len(rows) == len(targets):
+                # 全ての行を使う場合はコピーしない
+                distance_matrix = all_distances
+            else:
+                distance_matrix = all_distances[rows]
 
-            distance_matrix = np.array(
-                list_of_distances, dtype=np.float32)
-            del list_of_distances  # メモリ解放
+            del all_distances  # メモリ解放
 
             # 最寄りの面を取得
             logger.info("最寄りの面に割り当て")
@@ -245,8 +297,7 @@ class Build3d(object):
                     else:
                         mask = (nearest_face == k) & (distance_matrix[k, :] < 999.0)
 
-                    texture_images[n] = surface.create_texture_image(
-                        prefix=prefix, mask=mask, imagesize=imagesize)
+                    masks[n] = mask
 
             else:
                 """
@@ -258,79 +309,104 @@ class Build3d(object):
                 logger.info("テクスチャ画像作成開始（method:smart）")
                 for n, surface in enumerate(surfaces):
                     k = nkmap[n]
-                    mask = (nearest_face == k)
-                    projected_pcd = surface.get_projected_points()
-                    filtered_pcd = projected_pcd[mask]
-                    if len(filtered_pcd) == 0 or len(filtered_pcd[:, 2]) == 0:
-                        mask = False
-                    else:
-                        # filtered_points[:, 2] は壁面からの距離（内部は負）
-                        z = filtered_pcd[:, 2]
-                        z_range = (min(-1.0, max(-10.0, z.min())),
-                                   max(1.0, z.max()))
-                        z = projected_pcd[:, 2]
-                        mask = (z >= z_range[0]) & (z <= z_range[1])
+                    if k is None:
+                        # マッピング対象外の面
+                        masks[n] = False
+                        continue
 
-                    texture_images[n] = surface.create_texture_image(
-                        prefix=prefix, mask=mask, imagesize=imagesize)
+                    mask = (nearest_face == k)
+                    if not mask.any():
+                        # この面を最寄りとする点がない
+                        masks[n] = False
+                        continue
+
+                    # 投影後の Z 座標は壁面からの距離（内部は負）
+                    z = surface.get_projected_points()[:, 2]
+                    z_range = (min(-1.0, max(-10.0, z[mask].min())),
+                               max(1.0, z[mask].max()))
+                    masks[n] = (z >= z_range[0]) & (z <= z_range[1])
+
+        # 各面のテクスチャ画像は独立しているので並列に作成する
+        max_workers = os.environ.get('MAX_WORKERS', os.cpu_count() or 1)
+        max_workers = max(1, min(int(max_workers), nfaces))
+
+        def create_texture_image(surface, mask):
+            # 投影した点群は面の数だけ保持されるので、
+            # テクスチャ画像を作成したら解放する
+            try:
+                return surface.create_texture_image(
+                    mask=mask, prefix=prefix, imagesize=imagesize)
+            finally:
+                surface.projected_points = None
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers) as executor:
+            texture_images = list(executor.map(
+                create_texture_image, surfaces, masks))
 
         logger.info("テクスチャ画像作成完了")
 
+        # 法線ベクトルとテクスチャ座標を計算
+        vn_list = []
+        vt_list = []
+        vt_list_index = {}  # テクスチャ座標 -> vt_list 中の位置
+        vt_index = []
+        for n, surface in enumerate(surfaces):
+            vn_list.append(surface.projection_matrix[:, 2])
+
+            # テクスチャ座標を計算
+            minx, miny, maxx, maxy = surface.boundary
+            width, height = maxx - minx, maxy - miny
+            face_vt_index = []
+            for i, vertice in enumerate(
+                    surface.projected_vertices):
+                texture_coord = (
+                    round((vertice[0] - minx) / width, 3),
+                    round(1.0 - (vertice[1] - miny) / height, 3))
+                pos = vt_list_index.get(texture_coord)
+                if pos is None:
+                    pos = len(vt_list)
+                    vt_list_index[texture_coord] = pos
+                    vt_list.append(texture_coord)
+
+                face_vt_index.append(pos)
+
+            vt_index.append(face_vt_index)
+
         # OBJ ファイル出力
         # https://en.wikipedia.org/wiki/Wavefront_.obj_file
+        # 行ごとに書き込まず、各セクションの行をまとめて書き込む
         objfilename = os.path.join(self.dirname, "{}.obj".format(prefix))
         with open(objfilename, 'w') as f:
-            print("mtllib {}.mtl".format(prefix), file=f)
-            print("o {}".format(self.bldid), file=f)
+            f.write("mtllib {}.mtl\n".format(prefix))
+            f.write("o {}\n".format(self.bldid))
 
             # 頂点座標列を出力
-            for vertice in all_vertices:
-                print("v {:.4f} {:.4f} {:.4f}".format(
-                    vertice[0], vertice[1], vertice[2]),
-                    file=f)
-
-            # 法線ベクトルを出力しつつテクスチャ座標を計算
-            vt_list = []
-            vt_index = []
-            for n, surface in enumerate(surfaces):
-                nv = surface.projection_matrix[:, 2]
-                print("vn {:.4f} {:.4f} {:.4f}".format(
-                    nv[0], nv[1], nv[2]), file=f)
-
-                # テクスチャ座標を計算
-                minx, miny, maxx, maxy = surface.boundary
-                width, height = maxx - minx, maxy - miny
-                face_vt_index = []
-                for i, vertice in enumerate(
-                        surface.projected_vertices):
-                    texture_coord = (
-                        round((vertice[0] - minx) / width, 3),
-                        round(1.0 - (vertice[1] - miny) / height, 3))
-                    try:
-                        pos = vt_list.index(texture_coord)
-                    except ValueError:
-                        pos = len(vt_list)
-                        vt_list.append(texture_coord)
-
-                    face_vt_index.append(pos)
-
-                vt_index.append(face_vt_index)
+            f.writelines([
+                "v {:.4f} {:.4f} {:.4f}\n".format(v[0], v[1], v[2])
+                for v in all_vertices])
+
+            # 法線ベクトルを出力
+            f.writelines([
+                "vn {:.4f} {:.4f} {:.4f}\n".format(nv[0], nv[1], nv[2])
+                for nv in vn_list])
 
             # テクスチャ座標を出力
-            for tx, ty in vt_list:
-                print("vt {:.3f} {:.3f}".format(tx, ty), file=f)
+            f.writelines([
+                "vt {:.3f} {:.3f}\n".format(tx, ty)
+                for tx, ty in vt_list])
 
             # 面の列を出力
+            lines = []
             for n, vertices in enumerate(face_vertices):
-                print("usemtl {}".format(texture_images[n]), file=f)
-                values = []
-                for i, v in enumerate(vertices):
-                    values.append("{}/{}/{}".format(
-                        # 立体中の頂点, テクスチャ座標, 法線
-                        v + 1, vt_index[n][i] + 1, n + 1))
+                lines.append("usemtl {}\n".format(texture_images[n]))
+                values = [
+                    # 立体中の頂点, テクスチャ座標, 法線
+                    "{}/{}/{}".format(v + 1, vt_index[n][i] + 1, n + 1)
+                    for i, v in enumerate(vertices)]
+                lines.append("f {}\n".format(" ".join(values)))
 
-                print("f {}".format(" ".join(values)),
-                      file=f)
+            f.writelines(lines)
 
             logger.info("OBJ ファイル '{}' を出力完了".format(
                 os.path.basename(objfilename)))
@@ -340,12 +416,11 @@ class Build3d(object):
         mtlfilename = os.path.join(
             self.dirname, '{}.mtl'.format(prefix))
         with open(mtlfilename, 'w') as f:
-            for n in range(nfaces):
-                texture_image = texture_images[n]
-                print("newmtl {}".format(texture_image), file=f)
-                print("Kd 1 1 1\nNs 0\nd 1\nillum 1\nKa 0 0 0\nKs 1 1 1",
-                      file=f)
-                print("map_Kd {}".format(texture_image), file=f)
+            f.writelines([
+                "newmtl {0}\n"
+                "Kd 1 1 1\nNs 0\nd 1\nillum 1\nKa 0 0 0\nKs 1 1 1\n"
+                "map_Kd {0}\n".format(texture_image)
+                for texture_image in texture_images])
 
             logger.info("MTL ファイル '{}' を出力完了".format(
                 os.path.basename(mtlfilename)))
@@ -419,19 +494,94 @@ class Build3d(object):
         logger.info("三次元点群を建物ポリゴンで切り取り完了")
 
         # データ量を減らすためダウンサンプリング
-        down_pcd = copy.copy(pcd)
-        gridsize = self.GRIDSIZE
-        while limit_points > 0 and len(down_pcd.points) > limit_points:
-            down_pcd = pcd.voxel_down_sample(
-                voxel_size=gridsize)
-            logger.debug("gridsize:{:.02f} でダウンサンプリング ({})".format(
-                gridsize, len(down_pcd.points)))
-            self.gridsize = gridsize
-            gridsize *= 1.41421356
+        down_pcd = pcd
+        if limit_points > 0 and len(pcd.points) > limit_points:
+            # 点群は建物表面に分布するので、外接直方体の表面積を
+            # limit_points 個のボクセルで覆うグリッドサイズから始める
+            ex, ey, ez = pcd.get_axis_aligned_bounding_box().get_extent()
+            area = 2.0 * (ex * ey + ey * ez + ez * ex)
+            gridsize = max(self.GRIDSIZE, np.sqrt(area / limit_points))
+
+            # Open3D の Tensor API が使える場合は、
+            # マルチスレッドで動作する Tensor 版でダウンサンプリングする
+            use_tensor = hasattr(o3d, 't') and hasattr(
+                o3d.t.geometry.PointCloud, 'voxel_down_sample')
+            if use_tensor:
+                # 既定の float32 では平面直角座標の精度が不足する
+                tpcd = o3d.t.geometry.PointCloud.from_legacy(
+                    pcd, dtype=o3d.core.Dtype.Float64)
+
+            while True:
+                if use_tensor:
+                    down_pcd = tpcd.voxel_down_sample(
+                        voxel_size=gridsize).to_legacy()
+                else:
+                    down_pcd = pcd.voxel_down_sample(
+                        voxel_size=gridsize)
+
+                logger.debug(
+                    "gridsize:{:.02f} でダウンサンプリング ({})".format(
+                        gridsize, len(down_pcd.points)))
+                self.gridsize = gridsize
+                if len(down_pcd.points) <= limit_points:
+                    break
+
+                gridsize *= 1.2
+
+        return self.set_pointcloud(down_pcd)
+
+    def set_pointcloud(self, pcd):
+        """
+        建物領域の三次元点群を設定する。
 
-        self.pcd = down_pcd
+        Parameters
+        ----------
+        pcd: o3d.geometry.PointCloud
+            建物領域に一致する三次元点群
+
+        Returns
+        -------
+        o3d.geometry.PointCloud
+            設定した三次元点群
+        """
+        self.pcd = pcd
+        if self.surfaces is not None:
+            # 以前の点群を投影した結果は使えない
+            for surface in self.surfaces:
+                surface.projected_points = None
+
+        # 各面への投影で繰り返し参照するため配列として保持する
+        # 点群の最小座標を原点とした相対座標にすれば float32 でも
+        # 精度を保てるので、 X, Y, Z の列ごとに連続した配列にする
+        points = np.asarray(pcd.points)
+        if len(points) == 0:
+            self.points_origin = np.zeros(3)
+        else:
+            self.points_origin = points.min(axis=0)
+
+        self.points = np.asfortranarray(
+            points - self.points_origin, dtype=np.float32)
+        self.colors = np.asarray(pcd.colors, dtype=np.float32)
         return self.pcd
 
+    def get_points(self) -> np.ndarray:
+        """
+        三次元点群の座標の配列を取得する。
+
+        Returns
+        -------
+        numpy.ndarray(npoints, 3)
+            float32 の座標（self.points_origin からの相対座標）
+
+        Notes
+        -----
+        点群が未設定の場合のみ get_pointcloud() で読み込む。
+        """
+        if self.points is None:
+            self.get_pointcloud()
+
+        return self.points
+
     def write_pointcloud(self):
         """
         三次元点群を LAS ファイルに出力する。
@@ -445,7 +595,10 @@ class Build3d(object):
         logger.info(
             "PLY ファイル '{}' を出力完了".format(plyfilename))
 
-    def crop_point_cloud(self, pcd):
+    def crop_point_cloud(
+            self,
+            pcd,
+            tree: Optional[scipy.spatial.cKDTree] = None):
         """
         三次元点群を建物床面を垂直に伸ばした柱で切り取る。
 
@@ -453,6 +606,10 @@ class Build3d(object):
         ----------
         pcd: o3d.geometry.PointCloud
             入力となる三次元点群
+        tree: scipy.spatial.cKDTree, optional
+            pcd の X, Y 座標から作成した KD 木
+            指定した場合、建物の周辺にある点を KD 木で
+            絞り込んでから切り取る
 
         Returns
         -------
@@ -464,20 +621,45 @@ class Build3d(object):
         floor = plateau.geom.to_crs(self.crs)
         boundary = floor.buffer(self.BUFFER)
 
-        # 高さ 300 の柱状ボリュームを作成
-        select_vol = o3d.visualization.SelectionPolygonVolume()
-        select_vol.orthogonal_axis = "z"
-        select_vol.axis_min = 0
-        select_vol.axis_max = 300
-        bldg_ext_pts = list(boundary.exterior[0].coords)
-        polygon = np.array(bldg_ext_pts, dtype=np.float32)
-        polygon = np.insert(polygon, 2, 0, axis=1)
-        select_vol.bounding_polygon = o3d.utility.Vector3dVector(polygon)
+        region = boundary.iloc[0]
+        rminx, rminy, rmaxx, rmaxy = region.bounds
+        if region.area > 0.95 * (rmaxx - rminx) * (rmaxy - rminy):
+            # 切り取り範囲がほぼ軸に平行な矩形の場合は、
+            # 多角形の内外判定の代わりに高さ 300 の直方体で切り取る
+            select_vol = None
+            bbox = o3d.geometry.AxisAlignedBoundingBox(
+                np.array([rminx, rminy, 0.0]),
+                np.array([rmaxx, rmaxy, 300.0]))
+        else:
+            # 高さ 300 の柱状ボリュームを作成
+            select_vol = o3d.visualization.SelectionPolygonVolume()
+            select_vol.orthogonal_axis = "z"
+            select_vol.axis_min = 0
+            select_vol.axis_max = 300
+            coords = np.asarray(region.exterior.coords, dtype=np.float64)
+            polygon = np.zeros((len(coords), 3), dtype=np.float64)
+            polygon[:, 0:2] = coords[:, 0:2]
+            select_vol.bounding_polygon = o3d.utility.Vector3dVector(
+                polygon)
+
+        if tree is not None:
+            # 切り取り範囲の外接円に含まれる点のみを対象とする
+            minx, miny, maxx, maxy = boundary.total_bounds
+            center = ((minx + maxx) / 2.0, (miny + maxy) / 2.0)
+            radius = np.hypot(maxx - minx, maxy - miny) / 2.0
+            indexes = tree.query_ball_point(center, r=radius)
+            pcd = pcd.select_by_index(indexes)
 
         # Crop
+        if select_vol is None:
+            return pcd.crop(bbox)
+
         return select_vol.crop_point_cloud(pcd)
 
-    def count_points_near_walls(self, threshold: float = 1.0) -> int:
+    def count_points_near_walls(
+            self,
+            threshold: float = 1.0,
+            workers: int = -1) -> int:
         """
         壁面のそばの点の数をカウントする
 
@@ -485,59 +667,119 @@ class Build3d(object):
         ----------
         threshold: float
             壁面のそばと判定する距離のしきい値
+        workers: int
+            KD 木の探索に使うスレッド数、 -1 の場合は全ての CPU
+            建物ごとに並列実行する場合は 1 を指定する
 
         Returns
         -------
         int
             点群に含まれる点の数
         """
-        if self.pcd is None:
-            self.get_pointcloud()
-
-        if len(self.pcd.points) == 0:
+        points = self.get_points()
+        if len(points) == 0:
             return 0
 
-        building = self.get_building()
-        nfaces = len(building)
+        # 壁面のリストを取得
+        surfaces = self.get_surfaces()
+        if self.lod == 1:
+            # lod = 1 の時, 上面と底面には投影しない
+            surfaces = surfaces[1:-1]
+
+        # 壁面上に threshold 間隔で配置した標本点の近傍にある点を
+        # KD 木で候補として絞り込み、候補のみ壁面との距離を計算する
+        # 標本点の間の点も拾えるよう、探索半径は間隔の分だけ広げる
+        tree = scipy.spatial.cKDTree(points)
+        radius = threshold * np.sqrt(1.5)
+        near_wall = np.zeros(len(points), dtype=bool)
+        for surface in surfaces:
+            samples = surface.get_sample_points(spacing=threshold)
+            samples -= self.points_origin
+            hits = tree.query_ball_point(samples, r=radius, workers=workers)
+            candidates = np.fromiter(
+                itertools.chain.from_iterable(hits), dtype=np.intp)
+            candidates = np.unique(candidates)
+            if len(candidates) == 0:
+                continue
 
-        # 壁面のリストと面積を取得
-        surfaces = []
-        total_area = 0.0
-        for i in range(nfaces):
-            surface = Surface(i, build3d=self)
-            total_area += surface.area
-            surfaces.append(surface)
+            distances = surface.get_distance_matrix(
+                check_bounds=True, indexes=candidates)
+            near_wall[candidates[distances <= threshold]] = True
 
-        # 各壁面と点群の距離を計算
-        list_of_distances = []
-        for n, surface in enumerate(surfaces):
-            distances = surface.get_distance_matrix(check_bounds=True)
-            if self.lod == 1 and (n == 0 or n == len(surfaces) - 1):
-                # lod = 1 の時, 上面と底面には投影しない
-                distances = distances + 999.9
-
-            min_dist = distances.min()
-            logger.debug("- {}/{}, min_dist={:.3f}".format(
-                n + 1, nfaces, min_dist))
-            if min_dist > threshold:
-                # 面n に最も近い点がしきい値より離れているので
-                # マッピング対象外とする
-                continue
+        return int(near_wall.sum())
 
-            list_of_distances.append(distances)
+    def get_distance_matrix(
+            self,
+            surfaces: List["Surface"],
+            check_bounds: bool = False,
+            keep_threshold: Optional[float] = None) -> np.ndarray:
+        """
+        各面と点群の距離行列を作成する。
 
-        if len(list_of_distances) == 0:
-            return 0
+        Parameters
+        ----------
+        surfaces: List[Surface]
+            この建物の面のリスト
+        check_bounds: bool
+            正射投影時に面の範囲外になる点に対して、
+            ペナルティとして距離 999.9 を加算する。
+        keep_threshold: float, optional
+            点群との最小距離がこの値以下の面は、
+            投影した点群を Surface.projected_points に保持する。
+            省略した場合は保持しない。
 
-        distance_matrix = np.array(
-            list_of_distances, dtype=np.float32)
-        del list_of_distances  # メモリ解放
+        Returns
+        -------
+        numpy.ndarray(nsurfaces, npoints)
+            各面との距離（絶対値）の行列。
 
-        # 最寄りの面との距離を取得
-        dists = distance_matrix.min(axis=0)
-        count = (dists[:] <= threshold).sum()
+        Notes
+        -----
+        DISTANCE_BLOCK 個の面ごとに射影行列を (3 x 面数, 3) に積み重ね、
+        1 回の行列積で投影する。
+        一度に投影する配列は 点数 x DISTANCE_BLOCK x 3 に抑えられる。
+        """
+        points = self.get_points()
+        npoints = len(points)
+        distances = np.empty((len(surfaces), npoints), dtype=np.float32)
+
+        # 面の境界を (nsurfaces, 4) の連続した配列にまとめておく
+        boundaries = np.array(
+            [surface.boundary for surface in surfaces],
+            dtype=np.float32).reshape(-1, 4)
+        for start in range(0, len(surfaces), self.DISTANCE_BLOCK):
+            block = surfaces[start:start + self.DISTANCE_BLOCK]
+            nblock = len(block)
+
+            # 面ごとに (x, y, z) の 3 行が並ぶ (3 x nblock, npoints) に投影
+            # 点群は points_origin からの相対座標なので、
+            # 投影後に各面の原点の分をずらす
+            matrices = np.concatenate(
+                [surface.projection_matrix.T for surface in block])
+            offsets = np.concatenate(
+                [surface.get_projected_offset() for surface in block])
+            projected = np.matmul(matrices, points.T)
+            projected -= offsets[:, np.newaxis]
+            projected = projected.reshape(nblock, 3, npoints)
+
+            # 境界は [minx, miny, maxx, maxy] ごとに (nblock, 1) の配列にして
+            # (nblock, npoints) の範囲外判定をブロードキャストで行う
+            rows = distances[start:start + nblock]
+            calc_distances(
+                projected.transpose(0, 2, 1),
+                boundaries[start:start + nblock].T[:, :, np.newaxis],
+                check_bounds=check_bounds, out=rows)
+
+            if keep_threshold is None or npoints == 0:
+                continue
 
-        return int(count)
+            for surface, row, projected_points in zip(
+                    block, rows, projected):
+                if row.min() <= keep_threshold:
+                    surface.projected_points = np.ascontiguousarray(
+                        projected_points.T)
+
+        return distances
 
     def get_surface_area(self) -> float:
         """
@@ -548,17 +790,87 @@ class Build3d(object):
         float
             面積（平方メートル）
         """
-        building = self.get_building()
-        nfaces = len(building)
-
         # 壁面のリストと面積を取得
+        surfaces = self.get_surfaces()
         total_area = 0.0
-        for i in range(nfaces):
-            surface = Surface(i, build3d=self)
+        for surface in surfaces:
             total_area += surface.area
 
         return total_area
 
+    def get_surfaces(self) -> List["Surface"]:
+        """
+        建物オブジェクトの全ての面の Surface を取得する。
+
+        Returns
+        -------
+        List[Surface]
+            面のリスト（面番号順）
+
+        Notes
+        -----
+        初回の呼び出しで create_surfaces() により作成し、
+        以降は同じリストを返す。
+        """
+        if self.surfaces is None:
+            self.surfaces = self.create_surfaces()
+
+        return self.surfaces
+
+    def create_surfaces(self) -> List["Surface"]:
+        """
+        建物オブジェクトの全ての面の Surface を作成する。
+
+        Returns
+        -------
+        List[Surface]
+            面のリスト（面番号順）
+
+        Notes
+        -----
+        各面の射影行列と射影後の頂点列は、全ての面の頂点を
+        まとめた配列で一括して計算する。
+        計算方法は Surface.calc_basic_metrics() と同じ。
+        """
+        building = self.get_building()
+        rings = [
+            np.array(face.exterior.coords[:-1], dtype=np.float64)
+            for face in building.geom]
+        if len(rings) == 0:
+            return []
+
+        counts = np.array([len(ring) for ring in rings])
+        starts = np.cumsum(counts) - counts  # 各面の最初の頂点の位置
+        vertices = np.concatenate(rings)
+
+        # 各面の最初の点を原点とし、 0..1 の辺と 0..-1 の辺から
+        # 面の法線ベクトルと、面上で直交する基底を求める
+        origins = vertices[starts]
+        v0 = vertices[starts + 1] - origins
+        v1 = vertices[starts + counts - 1] - origins
+        v2 = np.cross(v0, v1)
+        v1 = np.cross(v2, v0)
+        units = [v / np.linalg.norm(v, axis=1, keepdims=True)
+                 for v in (v0, v1, v2)]
+        matrices = np.stack(units, axis=-1)  # (nfaces, 3, 3)
+
+        # 全ての頂点をそれぞれの面の v0-v1 平面に投影
+        face_ids = np.repeat(np.arange(len(rings)), counts)
+        projected_vertices = np.float32(np.einsum(
+            'ni,nij->nj',
+            vertices - origins[face_ids],
+            matrices[face_ids]))
+        projected_vertices = np.split(projected_vertices, starts[1:])
+        matrices = np.float32(matrices)
+
+        return [
+            Surface(
+                i, build3d=self,
+                origin=origins[i],
+                projection_matrix=matrices[i],
+                projected_vertices=projected_vertices[i])
+            for i in range(len(rings))]
+
 
 class Surface(object):
     """
@@ -570,7 +882,10 @@ class Surface(object):
     def __init__(
             self,
             face_number: int,
-            build3d: Build3d):
+            build3d: Build3d,
+            origin: Optional[np.ndarray] = None,
+            projection_matrix: Optional[np.ndarray] = None,
+            projected_vertices: Optional[np.ndarray] = None):
         """
         初期化する。
 
@@ -580,6 +895,10 @@ class Surface(object):
             建物オブジェクトの何番目の面かを表す数字（0 開始）
         build3d: Build3d
             この面を含む建物オブジェクト
+        origin, projection_matrix, projected_vertices: numpy.ndarray
+            計算済みの原点座標、射影行列、射影後の頂点列
+            Build3d.create_surfaces() から指定する。
+            省略した場合は calc_basic_metrics() で計算する。
         """
         building = build3d.get_building()
         # この面を構成する shapely.geometry.polygon.Polygon
@@ -592,8 +911,15 @@ class Surface(object):
         self.boundary = None  # X,Y 境界（射影後の座標系）
         self.area = None      # 面積（射影後の座標系）
         self.projected_vertices = None   # 頂点列（射影後の座標系）
-        self.projection_matrix = None    # 射影行列
-        self.calc_basic_metrics()
+        self.projection_matrix = None    # 射影行列（float32）
+        self.projected_points = None     # 三次元点群（射影後の座標系）
+        if projection_matrix is None:
+            self.calc_basic_metrics()
+        else:
+            self.origin = origin
+            self.projection_matrix = projection_matrix
+            self.projected_vertices = projected_vertices
+            self.calc_boundary()
 
     def calc_basic_metrics(self) -> NoReturn:
         """
@@ -628,7 +954,7 @@ class Surface(object):
         # d = - np.dot(u2, vertices[0])
 
         # 点群を v0-v1 平面に投影する行列
-        self.projection_matrix = np.array([
+        projection_matrix = np.array([
             (u0[0], u1[0], u2[0]),
             (u0[1], u1[1], u2[1]),
             (u0[2], u1[2], u2[2])],
@@ -637,7 +963,16 @@ class Surface(object):
         # 面の各頂点を v0-v1 平面に投影し、 X, Y の最小・最大を計算
         self.projected_vertices = np.float32(
             np.matmul(
-                vertices, self.projection_matrix))
+                vertices, projection_matrix))
+        self.calc_boundary()
+
+        # 点群は float32 で投影するので、射影行列も float32 で保持する
+        self.projection_matrix = np.float32(projection_matrix)
+
+    def calc_boundary(self) -> NoReturn:
+        """
+        射影後の頂点列から面積と X, Y 境界を計算する。
+        """
         try:
             self.area = shapely.geometry.Polygon(
                 self.projected_vertices[:, 0:2]).area
@@ -649,9 +984,12 @@ class Surface(object):
         y = self.projected_vertices[:, 1]
         minx, maxx = x.min(), x.max()
         miny, maxy = y.min(), y.max()
-        self.boundary = [minx, miny, maxx, maxy]
+        self.boundary = np.array([minx, miny, maxx, maxy], dtype=np.float32)
 
-    def get_distance_matrix(self, check_bounds: bool = False):
+    def get_distance_matrix(
+            self,
+            check_bounds: bool = False,
+            indexes: Optional[np.ndarray] = None):
         """
         面と点群の距離 [d] を作成する。
 
@@ -660,37 +998,100 @@ class Surface(object):
         check_bounds: bool
             正射投影時に面の範囲外になる点に対して、
             ペナルティとして距離 999.9 を加算する。
+        indexes: numpy.ndarray, optional
+            距離を計算する点のインデックス
+            省略した場合は全ての点
 
         Returns
         -------
         numpy.ndarray(npoints, 1)
             面との距離（絶対値）のベクトル。
         """
+        if indexes is None:
+            projected_points = self.get_projected_points()
+        else:
+            projected_points = self.project_points(
+                self.build3d.get_points()[indexes])
+
+        return calc_distances(
+            projected_points, self.boundary, check_bounds=check_bounds)
+
+    def get_sample_points(self, spacing: float) -> np.ndarray:
+        """
+        面の X, Y 境界内に格子状に配置した標本点を作成する。
+
+        Parameters
+        ----------
+        spacing: float
+            標本点の間隔の上限（メートル）
+
+        Returns
+        -------
+        numpy.ndarray(nsamples, 3)
+            標本点の座標（building の座標系）
+        """
         minx, miny, maxx, maxy = self.boundary
-        projected_points = self.get_projected_points()
-        x = projected_points[:, 0]
-        y = projected_points[:, 1]
-        z = projected_points[:, 2]
-        outbound_mask = (x < minx) | (x > maxx) | (y < miny) | (y > maxy)
-        distances = np.fabs(z, dtype=np.float32) + outbound_mask * 999.9
-        del projected_points
-        return distances
+        nx = int(np.ceil((maxx - minx) / spacing)) + 1
+        ny = int(np.ceil((maxy - miny) / spacing)) + 1
+        xx, yy = np.meshgrid(
+            np.linspace(minx, maxx, nx),
+            np.linspace(miny, maxy, ny))
+        samples = np.column_stack(
+            [xx.ravel(), yy.ravel(), np.zeros(xx.size)])
+
+        # 射影行列は直交行列なので、転置で元の座標系に戻す
+        return self.origin + np.matmul(samples, self.projection_matrix.T)
 
     def get_projected_points(self):
         """
         三次元点群を v0 - v1 平面に投影した点群を計算する。
+
+        Notes
+        -----
+        計算結果は self.projected_points に保持し、
+        2 回目以降の呼び出しでは再計算しない。
         """
-        pcd = self.build3d.get_pointcloud()
+        if self.projected_points is not None:
+            return self.projected_points
+
         # 三次元点群を v0-v1 平面に投影
-        points = np.asarray(pcd.points)
-        points = points - self.origin  # v[0] を原点に移動
-        projected_points = np.matmul(
-            points,
-            self.projection_matrix,
-            dtype=np.float32)  # v0-v1 平面に投影
+        self.projected_points = self.project_points(
+            self.build3d.get_points())
+        return self.projected_points
 
+    def project_points(self, points: np.ndarray) -> np.ndarray:
+        """
+        点の座標を v0 - v1 平面に投影する。
+
+        Parameters
+        ----------
+        points: numpy.ndarray(npoints, 3)
+            float32 の点の座標（Build3d.points_origin からの相対座標）
+
+        Returns
+        -------
+        numpy.ndarray(npoints, 3)
+            投影後の座標（float32）
+        """
+        projected_points = np.matmul(
+            points, self.projection_matrix)
+        projected_points -= self.get_projected_offset()  # v[0] を原点に移動
         return projected_points
 
+    def get_projected_offset(self) -> np.ndarray:
+        """
+        点群の原点 (Build3d.points_origin) から見た面の原点 (self.origin)
+        を v0 - v1 平面に投影した座標を求める。
+
+        Returns
+        -------
+        numpy.ndarray(3)
+            投影後の座標（float32）
+        """
+        return np.float32(np.matmul(
+            self.origin - self.build3d.points_origin,
+            self.projection_matrix))
+
     def create_texture_image(
             self,
             mask: Union[np.ndarray, bool] = True,
@@ -737,14 +1138,17 @@ class Surface(object):
             (maxy - miny) / (imagesize - 1.0),
             self.build3d.gridsize)
 
-        # v0-v1 平面に投影した三次元点群（全て）
-        projected_points = self.get_projected_points()
+        if np.any(mask):
+            # v0-v1 平面に投影した三次元点群（全て）
+            # mask で点が 1 つも選択されていない面では投影しない
+            projected_points = self.get_projected_points()
+
+            # mask で選択された点のうち、X, Y が面の範囲内にある点を抽出
+            x = projected_points[:, 0]
+            y = projected_points[:, 1]
+            mask = mask & (x >= minx) & (x <= maxx) & \
+                (y >= miny) & (y <= maxy)
 
-        # mask で選択された点のうち、X, Y が面の範囲内にある点を抽出
-        x = projected_points[:, 0]
-        y = projected_points[:, 1]
-        z = projected_points[:, 2]  # noqa F841
-        mask = mask & (x >= minx) & (x <= maxx) & (y >= miny) & (y <= maxy)
         if not np.any(mask):  # mask.sum() < 10000
             logger.debug("面{}には条件を満たす点がありません".format(
                 self.face_number))
@@ -752,13 +1156,17 @@ class Surface(object):
             self.pngfilename = os.path.join(
                 self.build3d.dirname, 'no_texture.png')
             if not os.path.exists(self.pngfilename):
-                image.save(self.pngfilename)
+                # 複数の面から同時に書き込まれても壊れないよう、
+                # 一時ファイルに書き込んでから置き換える
+                tmpfilename = "{}.{}.tmp".format(
+                    self.pngfilename, self.face_number)
+                image.save(tmpfilename, format='PNG')
+                os.replace(tmpfilename, self.pngfilename)
 
             return os.path.basename(self.pngfilename)
 
-        pcd = self.build3d.get_pointcloud()
         filtered_points = projected_points[mask]
-        filtered_colors = np.asarray(pcd.colors)[mask]
+        filtered_colors = self.build3d.colors[mask]
 
         # 点群を PLY ファイルに出力
         new_pcd = o3d.geometry.PointCloud()
@@ -781,26 +1189,39 @@ class Surface(object):
                 self.face_number, self.plyfilename))
 
         # 画像を作成
-        # [x, y, v] のリストから [[v]] の行列を作成する
-        # https://qiita.com/shu32/items/f19635eab402ea6fc44e
-        xyarray = filtered_points[:, 0:2]
+        # 各点を最寄りのピクセル（格子点）に割り当て、
+        # ピクセルごとに面に最も近い点の色を採用する（Z バッファ）
+        # 建物の反対側や内部の点が壁面の色を上書きしないようにする
         width = int((maxx - minx) / gridsize) + 1
         height = int((maxy - miny) / gridsize) + 1
-        new_xcoord = np.linspace(minx, maxx, width)
-        new_ycoord = np.linspace(miny, maxy, height)
-        xx, yy = np.meshgrid(new_xcoord, new_ycoord)
-        rgbarray = (scipy.interpolate.griddata(
-            xyarray,
-            filtered_colors[:, :],
-            (xx, yy),
-            method='nearest') * 256).astype(np.uint8)
-
+        xstep = (maxx - minx) / (width - 1) if width > 1 else gridsize
+        ystep = (maxy - miny) / (height - 1) if height > 1 else gridsize
+        fx = (filtered_points[:, 0] - minx) / xstep
+        fy = (filtered_points[:, 1] - miny) / ystep
+        ix = np.clip(np.rint(fx), 0, width - 1).astype(np.intp)
+        iy = np.clip(np.rint(fy), 0, height - 1).astype(np.intp)
+        pixels = iy * width + ix
+        offsets = ((fx - ix) * xstep) ** 2 + ((fy - iy) * ystep) ** 2
+        depths = np.fabs(filtered_points[:, 2])
+
+        # ピクセル順、面からの距離順（同じなら格子点からの距離順）に並べ、
+        # 各ピクセルの先頭を選ぶ
+        order = np.lexsort((offsets, depths, pixels))
+        sorted_pixels = pixels[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = sorted_pixels[1:] != sorted_pixels[:-1]
+        indexes = np.full(height * width, -1, dtype=np.intp)
+        indexes[sorted_pixels[first]] = order[first]
+        indexes = indexes.reshape(height, width)
+
+        # 点が割り当てられなかったピクセルは最寄りのピクセルの色で補完する
         # このままだと点群が大きく欠損している部分も全て埋めてしまうので
         # 補完するのは gridsize * 2 までに制限し、それ以上離れた部分は
         # (128, 128, 128) で塗りつぶす
-        tree = scipy.spatial.cKDTree(xyarray)
-        xi = scipy.interpolate.interpnd._ndim_coords_from_arrays((xx, yy))
-        dists, indexes = tree.query(xi)
+        dists, (nearest_y, nearest_x) = scipy.ndimage.distance_transform_edt(
+            indexes < 0, sampling=(ystep, xstep), return_indices=True)
+        indexes = indexes[nearest_y, nearest_x]
+        rgbarray = (filtered_colors[indexes] * 256).astype(np.uint8)
         rgbarray[dists > gridsize * 2] = 128
 
         # PNG ファイルに出力
@@ -1,73 +1,452 @@
+import csv
+import functools
+import io
 import json
 from logging import getLogger
+import math
 import os
 from typing import List, Optional
 
+from geoalchemy2.elements import WKBElement
 import geopandas as gpd
 import shapely
+import shapely.wkb
 from shapely.geometry import Polygon
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
 from .model import Plateau, Plateau_LOD2
 
 logger = getLogger(__name__)
 
+# プロセス内で共有するエンジンとコネクションプール
+# pre-ping は行わず、一定時間で接続を作り直す
+# PostgreSQL に直接接続するか、 PgBouncer などのプーラーを
+# セッションモードまたはトランザクションモードで経由すること。
+# マッチング用の一時テーブルと PREPARE 文はセッションに紐づくが、
+# prepare_match_tables() がトランザクションごとにサーバー側で
+# 存在を確認して作り直すため、トランザクションモードでも動作する。
+# 複数の文からなるトランザクションを使うため、ステートメントモードは不可。
+# エンジンはプロセス全体で共有するため、 SQL のログ出力は
+# 環境変数 SQL_ECHO で一度だけ指定する。
+engine = create_engine(
+    "postgresql://{}:{}@{}:{}/{}".format(
+        os.environ.get('POSTGRES_USER', 'pguser'),
+        os.environ.get('POSTGRES_PASSWORD', 'pgpass'),
+        os.environ.get('POSTGRES_HOST', 'localhost'),
+        os.environ.get('POSTGRES_PORT', 5432),
+        os.environ.get('POSTGRES_DB', 'pgdb')),
+    poolclass=QueuePool,
+    pool_size=10,
+    max_overflow=5,
+    pool_recycle=60,
+    pool_pre_ping=False,
+    pool_timeout=30,
+    echo=os.environ.get('SQL_ECHO', 'False').lower() in ('true', '1'))
+Session = sessionmaker(bind=engine)
+
+# LOD ごとの Plateau モデルと、建物IDで検索する SQL
+_PLATEAU_MODELS = {1: Plateau, 2: Plateau_LOD2}
+_SELECT_PLATEAU_ROWS = {
+    lod: text(
+        "SELECT fid, bldid, area, geom, geom3d FROM "
+        f"{model.__tablename__} WHERE bldID=:bldid ORDER BY fid")
+    for lod, model in _PLATEAU_MODELS.items()
+}
+
+# Polygon と交差する Plateau 建物を検索する SQL
+# テーブル名は固定なので、モジュールの読み込み時に一度だけ組み立てる
+_SEARCH_BY_POLYGON = text(f"""
+    WITH polygons AS (
+        SELECT
+            row_number() OVER () AS pid,
+            geoms.geom AS polygon,
+            ST_Area(geoms.geom::geography) AS area
+        FROM
+            ( SELECT
+                (ST_Dump(ST_Force2D(ST_GeomFromEWKT(:polygon)))).geom
+                AS geom
+            ) geoms
+        WHERE GeometryType(geoms.geom) = 'POLYGON'
+    ), tiles AS (
+        -- 大きな Polygon との交差計算を軽くするため
+        -- 頂点数 256 以下のタイルに分割しておく
+        SELECT
+            polygons.pid,
+            tile AS geom,
+            ST_Area(tile::geography) AS area
+        FROM
+            polygons
+            CROSS JOIN LATERAL
+                ST_Subdivide(polygons.polygon, 256) AS tile
+    )
+    SELECT
+        fid AS plateau_fid,
+        bldid AS plateau_bldid,
+        area AS plateau_area,
+        ST_AsBinary(ST_ForcePolygonCCW(geom)) AS plateau_geom,
+        polygon_area,
+        intersection_area,
+        dist,
+        intersection_area / polygon_area > 0.4
+        OR intersection_area / area > 0.4 AS is_overlapped
+    FROM (
+        SELECT
+            plateau.*,
+            (
+                -- タイルごとに交差部分の面積を求めて合計する
+                -- 一方が他方に含まれる場合は交差部分を計算しない
+                SELECT COALESCE(SUM(
+                    CASE
+                        WHEN ST_CoveredBy(plateau.geom, tiles.geom)
+                            THEN plateau.area
+                        WHEN ST_CoveredBy(tiles.geom, plateau.geom)
+                            THEN tiles.area
+                        ELSE ST_Area(
+                            ST_Intersection(
+                                plateau.geom, tiles.geom)::geography)
+                    END), 0.0)
+                FROM
+                    tiles
+                WHERE
+                    tiles.pid = polygons.pid
+                    AND ST_Intersects(plateau.geom, tiles.geom)
+            ) AS intersection_area,
+            polygons.area AS polygon_area,
+            plateau.area / polygons.area AS area_ratio,
+            ST_Distance(
+                plateau.centroid_geog,
+                ST_Centroid(polygons.polygon)::geography) AS dist
+        FROM
+            "{Plateau.__tablename__}" AS plateau,
+            polygons
+        WHERE
+            plateau.geom && polygons.polygon
+        ) s2
+    WHERE
+        intersection_area / polygon_area > 0.4
+        OR intersection_area / area > 0.4
+        OR (
+            dist < 10.0 AND area_ratio > 0.8 AND area_ratio < 1.2
+        )
+    ORDER BY
+        plateau_bldid ASC,
+        is_overlapped DESC
+    """)
+
+# Polygon の外接矩形と交差する Plateau 建物を検索する SQL
+_SEARCH_PLATEAU_INTERSECTS_POLYGON = text(f"""
+    SELECT
+        plateau.fid AS plateau_fid,
+        plateau.bldid AS plateau_bldid,
+        plateau.area AS plateau_area,
+        ST_AsBinary(ST_ForcePolygonCCW(plateau.geom)) AS plateau_geom
+    FROM
+        "{Plateau.__tablename__}" AS plateau
+    WHERE
+        plateau.geom && ST_Transform(ST_GeomFromEWKT(:polygon), 4326)
+    ORDER BY
+        plateau_bldid ASC
+    """)
+
+
+# 建物ごとの行は LOD2 では面の数に応じて大きくなるため、
+# キャッシュする建物数は LOD によらず 1024 件までとする
+@functools.lru_cache(maxsize=1024)
+def _get_plateau_rows(bldid: str, lod: int = 1) -> tuple:
+    """
+    Plateau 建物IDを指定して PostgreSQL から検索し、
+    該当する行のタプルを返す。
+
+    Plateau テーブルは更新されないため、結果をキャッシュして
+    同じ建物の検索を繰り返さないようにする。
+    呼び出し元で変更されないよう、 ORM オブジェクトや
+    GeoDataFrame ではなく、ジオメトリを HEXEWKB 文字列のまま
+    保持したタプルをキャッシュする。
+
+    Parameters
+    ----------
+    bldid: str
+        Plateau bldID
+    lod: int
+        LOD を指定する。省略した場合は 1。
+
+    Returns
+    -------
+    tuple
+        (fid, bldid, area, geom, geom3d) のタプル
+    """
+    # LOD 1, 2 以外が指定された場合は LOD 1 のテーブルを検索する
+    sql = _SELECT_PLATEAU_ROWS.get(lod, _SELECT_PLATEAU_ROWS[1])
+    with engine.connect() as con:
+        rows = con.execute(sql, {"bldid": bldid})
+        return tuple(tuple(row) for row in rows)
+
+
+def _replace_nonfinite(value):
+    """
+    properties に含まれる NaN, Infinity を None に置き換える。
+
+    Parameters
+    ----------
+    value: any
+        JSON としてデコードされた値
+
+    Returns
+    -------
+    any
+        NaN, Infinity を None に置き換えた値
+
+    Notes
+    -----
+    request.json は NaN, Infinity を受け付けるが、
+    PostgreSQL の json 型には格納できないため null とする。
+    """
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    elif isinstance(value, dict):
+        return {k: _replace_nonfinite(v) for k, v in value.items()}
+    elif isinstance(value, list):
+        return [_replace_nonfinite(v) for v in value]
+
+    return value
+
 
 class Database(object):
     # ref: https://geoalchemy-2.readthedocs.io/en/latest/orm_tutorial.html
 
-    def __init__(self, echo: bool = False):
-        self.dbuser = dbuser = os.environ.get('POSTGRES_USER', 'pguser')
-        self.dbpass = dbpass = os.environ.get('POSTGRES_PASSWORD', 'pgpass')
-        self.dbhost = dbhost = os.environ.get('POSTGRES_HOST', 'localhost')
-        self.dbport = dbport = os.environ.get('POSTGRES_PORT', 5432)
-        self.dbname = dbname = os.environ.get('POSTGRES_DB', 'pgdb')
-        self.engine = create_engine(
-            f'postgresql://{dbuser}:{dbpass}@{dbhost}:{dbport}/{dbname}',
-            echo=echo)
+    ITERSIZE = 1000  # サーバーサイドカーソルで一度に取得する行数
 
-        self.Session = sessionmaker(bind=self.engine)
-        self.current_session = None
+    # prepare_match_tables() で作成する PREPARE 文
+    MATCH_STATEMENTS = (
+        "insert_polygons", "insert_polygon_tiles", "insert_joined")
 
-    def __del__(self):
-        self.close_session()
+    # join_table_with_plateau() で properties の末尾に追加するキー
+    MATCH_PROPERTIES = (
+        "plateau_bldid", "plateau_area", "intersection_area",
+        "source_area", "area_ratio", "dist", "confidence")
 
-    def close_session(self):
-        if self.current_session:
-            self.current_session.close()
+    def __init__(self):
+        self.engine = engine
+        self.Session = Session
 
-        self.current_session = None
+    def prepare_match_tables(self, connection):
+        """
+        マッチング用の一時テーブルと PREPARE 文を作成する。
 
-    def get_session(self):
-        if self.current_session:
-            return self.current_session
-        else:
-            self.current_session = self.Session()
+        Parameters
+        ----------
+        connection: sqlalchemy.engine.Connection
+            一時テーブルを作成するコネクション
+
+        Notes
+        -----
+        一時テーブルと PREPARE 文はサーバー側のセッションに紐づくため、
+        マッチング処理を行うトランザクションの中で呼び出すこと。
+        同じセッションで作成済みの場合はそのまま利用するので、
+        コネクションプールから再利用されたコネクションでは作成を省略できる。
+        作成済みかどうかはクライアント側で記録せず、毎回サーバーに
+        問い合わせるため、 PgBouncer のトランザクションプーリングで
+        トランザクションごとに別のセッションに割り当てられても動作する。
+        テーブル名はセッション内で閉じているため衝突せず、
+        セッションの終了時に自動的に削除される。
+        一時テーブルは ON COMMIT DELETE ROWS で作成するため、
+        トランザクション終了時に空になる。
+        """
+        tables_exist, prepared = connection.exec_driver_sql(
+            "SELECT to_regclass('pg_temp.joined') IS NOT NULL, "
+            "ARRAY(SELECT name::text FROM pg_prepared_statements "
+            "WHERE name = ANY(%s))",
+            (list(self.MATCH_STATEMENTS),)).one()
+        if tables_exist and len(prepared) == len(self.MATCH_STATEMENTS):
+            return
+
+        # 一部だけ残っている場合（PREPARE はロールバックされない）に備え、
+        # 作成済みの PREPARE 文は作り直す
+        for name in prepared:
+            connection.exec_driver_sql(f"DEALLOCATE {name}")
 
-        return self.current_session
+        sql = f"""
+            CREATE TEMPORARY TABLE IF NOT EXISTS tmp_features (
+                id integer,
+                properties json,
+                geometry geometry(Geometry, 4326)
+            ) ON COMMIT DELETE ROWS;
+
+            CREATE TEMPORARY TABLE IF NOT EXISTS polygons (
+                id integer,
+                properties json,
+                __geom geometry(Geometry, 4326),
+                __area double precision,
+                __pid serial
+            ) ON COMMIT DELETE ROWS;
+
+            CREATE INDEX IF NOT EXISTS idx_polygons_geom
+                ON polygons USING gist(__geom);
+
+            CREATE TEMPORARY TABLE IF NOT EXISTS polygon_tiles (
+                pid integer,
+                geom geometry(Geometry, 4326),
+                area double precision
+            ) ON COMMIT DELETE ROWS;
+
+            CREATE INDEX IF NOT EXISTS idx_polygon_tiles_geom
+                ON polygon_tiles USING gist(geom);
+
+            CREATE TEMPORARY TABLE IF NOT EXISTS joined (
+                id integer,
+                properties json,
+                __geom geometry(Geometry, 4326),
+                __area double precision,
+                plateau_bldid text,
+                plateau_area double precision,
+                plateau_geom geometry(Geometry, 4326),
+                intersection_area double precision,
+                source_area double precision,
+                area_ratio double precision,
+                dist double precision,
+                is_overlapped boolean
+            ) ON COMMIT DELETE ROWS;
+
+            -- MultiPolygon を展開し Polygon を選択
+            PREPARE insert_polygons AS
+            INSERT INTO polygons (id, properties, __geom, __area)
+            SELECT
+                geoms.id,
+                geoms.properties,
+                geoms.__geom,
+                ST_Area(geoms.__geom::geography) AS __area
+            FROM (
+                SELECT
+                    id, properties,
+                    -- 空間結合で使うため、ここで 2D にしておく
+                    ST_Force2D(
+                        ST_Buffer((ST_Dump(geometry)).geom, 0)) AS __geom
+                FROM tmp_features
+                ) geoms
+            WHERE
+                GeometryType(geoms.__geom) = 'POLYGON';
+
+            -- 大きな Polygon との交差計算を軽くするため
+            -- 頂点数 256 以下のタイルに分割しておく
+            PREPARE insert_polygon_tiles AS
+            INSERT INTO polygon_tiles
+            SELECT
+                polygons.__pid,
+                tile,
+                ST_Area(tile::geography)
+            FROM
+                polygons
+                CROSS JOIN LATERAL
+                    ST_Subdivide(polygons.__geom, 256) AS tile;
+
+            -- Polygon と Plateau を空間結合し、
+            -- マッチング条件を満たす組み合わせのみを格納する
+            PREPARE insert_joined AS
+            INSERT INTO joined
+            SELECT
+                pairs.*,
+                pairs.intersection_area / pairs.source_area > 0.4
+                OR pairs.intersection_area / pairs.plateau_area > 0.4
+                AS is_overlapped
+            FROM (
+                SELECT
+                    polygons.id,
+                    polygons.properties,
+                    polygons.__geom,
+                    polygons.__area,
+                    plateau.bldid AS plateau_bldid,
+                    plateau.area AS plateau_area,
+                    plateau.geom AS plateau_geom,
+                    (
+                        -- タイルごとに交差部分の面積を求めて合計する
+                        -- 一方が他方に含まれる場合は交差部分を計算しない
+                        SELECT COALESCE(SUM(
+                            CASE
+                                WHEN ST_CoveredBy(plateau.geom, tiles.geom)
+                                    THEN plateau.area
+                                WHEN ST_CoveredBy(tiles.geom, plateau.geom)
+                                    THEN tiles.area
+                                ELSE ST_Area(
+                                    ST_Intersection(
+                                        plateau.geom, tiles.geom)::geography)
+                            END), 0.0)
+                        FROM
+                            polygon_tiles AS tiles
+                        WHERE
+                            tiles.pid = polygons.__pid
+                            AND ST_Intersects(plateau.geom, tiles.geom)
+                    ) AS intersection_area,
+                    polygons.__area AS source_area,
+                    plateau.area / polygons.__area AS area_ratio,
+                    ST_Distance(
+                        plateau.centroid_geog,
+                        ST_Centroid(polygons.__geom)::geography) AS dist
+                FROM
+                    "{Plateau.__tablename__}" AS plateau,
+                    polygons
+                WHERE
+                    plateau.geom && polygons.__geom
+                -- 交差面積の計算が条件ごとに重複しないよう
+                -- サブクエリの展開を抑止する
+                OFFSET 0
+                ) pairs
+            WHERE
+                pairs.intersection_area / pairs.source_area > 0.4
+                OR pairs.intersection_area / pairs.plateau_area > 0.4
+                OR (
+                    pairs.dist < 10.0
+                    AND pairs.area_ratio > 0.8 AND pairs.area_ratio < 1.2
+                );
+            """
+        logger.debug("マッチング用の一時テーブルと PREPARE 文を作成")
+        connection.exec_driver_sql(sql)
 
-    def create_table(self, tablename: str, features: list):
+    def create_temp_features(self, connection, features: list):
         """
-        Feature Collection からテーブルを作成する。
+        Feature のリストを一時テーブル tmp_features に登録する。
 
         Parameters
         ----------
-        tablename: str
-            作成するテーブル名
+        connection: sqlalchemy.engine.Connection
+            prepare_match_tables() を実行したコネクション
         features: List[feature]
             レコードとして登録するfeature のリスト
-        """
-        gdf = gpd.GeoDataFrame.from_features(features, crs='EPSG:4326')
 
-        with self.engine.connect() as con:
-            # PostGISに出力 (オプション： データ置き換え、indexなし)
-            gdf.to_postgis(
-                tablename,
-                con,
-                if_exists='replace',
-                index=False,
-            )
+        Notes
+        -----
+        登録したレコードはトランザクション終了時に削除される。
+        properties はキーの順序を保つため json 型の列に格納する。
+        MATCH_PROPERTIES と同じキーは結合結果で置き換えるため除外し、
+        json 型に格納できない NaN, Infinity は null に置き換える。
+        """
+        # COPY 用の CSV を作成、ジオメトリは SRID 付き HEXEWKB
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        for i, feature in enumerate(features):
+            geometry = feature.get("geometry")
+            if geometry is None:
+                wkb = None
+            else:
+                wkb = shapely.wkb.dumps(
+                    shapely.geometry.shape(geometry),
+                    hex=True, srid=4326)
+
+            properties = {
+                k: _replace_nonfinite(v)
+                for k, v in (feature.get("properties") or {}).items()
+                if k not in self.MATCH_PROPERTIES}
+            writer.writerow((
+                i,
+                json.dumps(properties, ensure_ascii=False, allow_nan=False),
+                wkb))
+
+        buf.seek(0)
+        cursor = connection.connection.cursor()
+        cursor.copy_expert(
+            "COPY tmp_features (id, properties, geometry) "
+            "FROM STDIN WITH (FORMAT csv)", buf)
 
     """
     Plateau 操作メソッド
@@ -75,21 +454,29 @@ class Database(object):
 
     def check_plateau_table_exists(self) -> bool:
         from sqlalchemy.exc import ProgrammingError
-        try:
-            self.get_session().query(Plateau.bldid).first()
-        except ProgrammingError:
-            self.close_session()
-            return False
+        with self.Session() as session:
+            try:
+                session.query(Plateau.bldid).first()
+            except ProgrammingError:
+                return False
+
         return True
 
     def get_plateau_by_fid(self, fid: int) -> Optional[Plateau]:
-        plateau = self.get_session().query(Plateau).get(fid)
+        with self.Session() as session:
+            plateau = session.query(Plateau).get(fid)
+
         return plateau
 
     def get_plateau_by_bldid(self, bldid: str) -> Optional[Plateau]:
-        plateau = self.get_session().query(Plateau).filter(
-            Plateau.bldid == bldid).first()
-        return plateau
+        rows = _get_plateau_rows(bldid, 1)
+        if len(rows) == 0:
+            return None
+
+        fid, bldid, area, geom, _ = rows[0]
+        return Plateau(
+            fid=fid, bldid=bldid, area=area,
+            geom=WKBElement(bytes.fromhex(geom), extended=True))
 
     def get_plateau_building(self, bldid: str, lod: int = 1) -> Optional:
         """
@@ -103,27 +490,29 @@ class Database(object):
         lod: int
             LOD を指定する。省略した場合は 1。
         """
-        tablename = Plateau.__tablename__
-        if lod == 2:
-            tablename = Plateau_LOD2.__tablename__
-
-        with self.engine.connect() as con:
-            sql = (
-                "SELECT fid, bldid, geom3d AS geom FROM "
-                f"{tablename} WHERE bldID=%s")
-            gdf = gpd.GeoDataFrame.from_postgis(
-                sql=sql,
-                con=con,
-                geom_col="geom",
-                params=[bldid])
-
-            if len(gdf) == 0:
-                return None
-
-            # Convert MultiPolygonZ to list of PolygonZ objects
-            exploded = gdf.explode(index_parts=True)
-
-            return exploded
+        rows = _get_plateau_rows(bldid, lod)
+        if len(rows) == 0:
+            return None
+
+        # Convert MultiPolygonZ to list of PolygonZ objects
+        # GeoDataFrame.explode() を使わず、直接ポリゴンを列挙する
+        fids, bldids, parts = [], [], []
+        for row in rows:
+            geom3d = shapely.wkb.loads(row[4], hex=True)
+            if geom3d.geom_type.startswith('Multi'):
+                polygons = list(geom3d.geoms)
+            else:
+                polygons = [geom3d]
+
+            fids += [row[0]] * len(polygons)
+            bldids += [row[1]] * len(polygons)
+            parts += polygons
+
+        return gpd.GeoDataFrame({
+            "fid": fids,
+            "bldid": bldids,
+            "geom": parts,
+        }, geometry="geom", crs="EPSG:4326")
 
     def get_plateau_building_2d(self, bldid: str, lod: int = 1) -> Optional:
         """
@@ -137,173 +526,90 @@ class Database(object):
         lod: int
             LOD を指定する。省略した場合は 1。
         """
-        tablename = Plateau.__tablename__
-        if lod == 2:
-            tablename = Plateau_LOD2.__tablename__
-
-        with self.engine.connect() as con:
-            sql = (
-                "SELECT fid, bldid, geom FROM "
-                f"{tablename} WHERE bldID=%s")
-            gdf = gpd.GeoDataFrame.from_postgis(
-                sql=sql,
-                con=con,
-                geom_col="geom",
-                params=[bldid])
-
-            if len(gdf) == 0:
-                return None
-
-            return gdf
-
-    def join_table_with_plateau(self, tablename: str) -> List[Plateau]:
+        rows = _get_plateau_rows(bldid, lod)
+        if len(rows) == 0:
+            return None
+
+        return gpd.GeoDataFrame({
+            "fid": [row[0] for row in rows],
+            "bldid": [row[1] for row in rows],
+            "geom": [shapely.wkb.loads(row[3], hex=True) for row in rows],
+        }, geometry="geom", crs="EPSG:4326")
+
+    def join_table_with_plateau(self, connection):
         """
-        指定したテーブルと Plateau 2D テーブルを結合し、
+        一時テーブル tmp_features と Plateau 2D テーブルを結合し、
         Plateau レコードを返す。
 
         Paramters
         ---------
-        tablename: str
-            結合するテーブル名
+        connection: sqlalchemy.engine.Connection
+            create_temp_features() でレコードを登録したコネクション
 
         Returns
         -------
-        List[Plateau]
-            マッチする Plateau レコードのリスト
+        psycopg2.extensions.cursor
+            マッチする Plateau 建物ごとに
+            (plateau_bldid, is_overlapped, feature) を順に返す名前付きカーソル
+            feature は GeoJSON Feature の文字列
 
         Note
         ----
         マッチングの条件は以下の通り。
         - Plateau ポリゴンと検索ポリゴンが交差する部分の面積が
           検索ポリゴン全体の面積の 0.2 倍以上
+        カーソルと作業用の一時テーブルのレコードは
+        トランザクション終了時に削除される。
         """
-        with self.Session() as sess:
-            sql0 = f"""
-                CREATE TEMPORARY TABLE polygons AS (
-                SELECT
-                    geoms.*,
-                    ST_Area(geoms.__geom::geography) AS __area
-                FROM (
-                    SELECT
-                        *, ST_Buffer((ST_Dump(geometry)).geom, 0) AS __geom
-                    FROM {tablename}
-                    ) geoms
-                WHERE
-                    GeometryType(geoms.__geom) = 'POLYGON'
-                )
-                """
-            logger.debug("MultiPolygon を展開し Polygon を選択")
-            sess.execute(sql0)
-            logger.debug("空間インデックスを生成")
-            sess.execute("ALTER TABLE polygons DROP COLUMN geometry")
-            sess.execute((
-                "CREATE INDEX idx_polygons_geom ON polygons"
-                " USING gist(__geom)"))
-
-            sql1 = f"""
-                CREATE TEMPORARY TABLE joined AS (
-                SELECT
-                    polygons.*,
-                    plateau.bldid AS plateau_bldid,
-                    plateau.area AS plateau_area,
-                    plateau.geom AS plateau_geom,
-                    ST_Area(
-                        ST_Intersection(
-                            plateau.geom,
-                            ST_Force2D(polygons.__geom)
-                        )::geography
-                    ) AS intersection_area,
-                    polygons.__area AS source_area,
-                    plateau.area / polygons.__area AS area_ratio,
-                    ST_Distance(
-                        ST_Centroid(plateau.geom)::geography,
-                        ST_Centroid(polygons.__geom)::geography) AS dist
-                FROM
-                    "{Plateau.__tablename__}" AS plateau,
-                    polygons
-                WHERE
-                    plateau.geom && polygons.__geom
-                )
-                """
-            logger.debug("Polygon と Plateua を空間結合")
-            sess.execute(sql1)
-
-            sql2 = f"""
-                SELECT
-                    *,
-                    ST_AsGeoJSON(plateau_geom) AS plateau_geom,
-                    intersection_area / source_area > 0.4
-                    OR intersection_area / plateau_area > 0.4 AS is_overlapped
-                FROM
-                    joined
-                WHERE
-                    intersection_area / source_area > 0.4
-                    OR intersection_area / plateau_area > 0.4
-                    OR (
-                        dist < 10.0 AND area_ratio > 0.8 AND area_ratio < 1.2
-                    )
-                ORDER BY
-                    plateau_bldid ASC,
-                    is_overlapped DESC
-                """
-            logger.debug("面積比と重心間距離で絞り込み")
-            results = sess.execute(sql2)
-
-        return results
-
-        sql = f"""
-            WITH source AS (
-                SELECT
-                    geoms.*,
-                    ST_Area(geoms.__geom::geography) AS __area
-                FROM (
-                    SELECT
-                        *, (ST_Dump(geometry)).geom AS __geom
-                    FROM {tablename}
-                    ) geoms
-                WHERE GeometryType(geoms.__geom) = 'POLYGON'
-            )
+        logger.debug("MultiPolygon を展開し Polygon を選択")
+        connection.exec_driver_sql("EXECUTE insert_polygons")
+        connection.exec_driver_sql("EXECUTE insert_polygon_tiles")
+        logger.debug("Polygon と Plateau を空間結合し、面積比と重心間距離で絞り込み")
+        connection.exec_driver_sql("EXECUTE insert_joined")
+
+        # Feature の JSON は PostGIS 側で組み立てる
+        # properties は入力 Feature の properties の末尾に結合結果を追加したもの
+        # jsonb の結合はキーを並べ替えるため、 json のテキストをつなげて
+        # 入力のキーの順序を保ち、 confidence を最後にする
+        sql2 = """
             SELECT
-                *,
-                ST_AsGeoJSON(plateau_geom) AS plateau_geom,
-                intersection_area / source_area > 0.4
-                OR intersection_area / plateau_area > 0.4 AS is_overlapped
-            FROM (
-                SELECT
-                    source.*,
-                    plateau.bldid AS plateau_bldid,
-                    plateau.area AS plateau_area,
-                    plateau.geom AS plateau_geom,
-                    ST_Area(
-                        ST_Intersection(
-                            plateau.geom,
-                            ST_Force2D(source.__geom)
-                        )::geography
-                    ) AS intersection_area,
-                    source.__area AS source_area,
-                    plateau.area / source.__area AS area_ratio,
-                    ST_Distance(
-                        ST_Centroid(plateau.geom)::geography,
-                        ST_Centroid(source.__geom)::geography) AS dist
-                FROM
-                    "{Plateau.__tablename__}" AS plateau,
-                    source
-                WHERE
-                    plateau.geom && source.__geom
-                ) s2
-            WHERE
-                intersection_area / source_area > 0.4
-                OR intersection_area / plateau_area > 0.4
-                OR (
-                    dist < 10.0 AND area_ratio > 0.8 AND area_ratio < 1.2
-                )
+                plateau_bldid,
+                is_overlapped,
+                json_build_object(
+                    'type', 'Feature',
+                    'geometry', ST_AsGeoJSON(
+                        ST_ForcePolygonCCW(plateau_geom), 15)::json,
+                    'properties', (
+                        CASE properties::text
+                            WHEN '{}' THEN '{'
+                            ELSE left(properties::text, -1) || ', '
+                        END || right(json_build_object(
+                            'plateau_bldid', plateau_bldid,
+                            'plateau_area',
+                            round(plateau_area::numeric, 4)::float8,
+                            'intersection_area',
+                            round(intersection_area::numeric, 4)::float8,
+                            'source_area',
+                            round(source_area::numeric, 4)::float8,
+                            'area_ratio',
+                            round(area_ratio::numeric, 2)::float8,
+                            'dist', round(dist::numeric, 2)::float8,
+                            'confidence',
+                            CASE WHEN is_overlapped THEN 'high' ELSE 'low' END
+                        )::text, -1))::json
+                )::text AS feature
+            FROM
+                joined
             ORDER BY
                 plateau_bldid ASC,
                 is_overlapped DESC
             """
+        # サーバーサイドカーソルで ITERSIZE 行ずつ取得する
+        cursor = connection.connection.cursor(name="joined_cursor")
+        cursor.itersize = self.ITERSIZE
+        cursor.execute(sql2)
 
-        results = self.get_session().execute(sql)
-        return results
+        return cursor
 
     def search_by_polygon(self, polygon: Polygon) -> List[Plateau]:
         """
@@ -324,70 +630,19 @@ class Database(object):
         マッチングの条件は以下の通り。
         - Plateau ポリゴンと検索ポリゴンが交差する部分の面積が
           検索ポリゴン全体の面積の 0.2 倍以上
+        plateau_geom は反時計回りに並べ替えた Polygon の WKB。
         """
-        sql = f"""
-            WITH polygons AS (
-                SELECT
-                    geoms.geom AS polygon,
-                    ST_Area(geoms.geom::geography) AS area
-                FROM
-                    ( SELECT
-                        (ST_Dump(ST_GeomFromEWKT(:polygon))).geom AS geom
-                    ) geoms
-                WHERE GeometryType(geoms.geom) = 'POLYGON'
-            )
-            SELECT
-                fid AS plateau_fid,
-                bldid AS plateau_bldid,
-                area AS plateau_area,
-                ST_AsGeoJSON(geom) AS plateau_geom,
-                polygon_area,
-                intersection_area,
-                dist,
-                intersection_area / polygon_area > 0.4
-                OR intersection_area / area > 0.4 AS is_overlapped
-            FROM (
-                SELECT
-                    plateau.*,
-                    ST_Area(
-                        ST_Intersection(
-                            plateau.geom,
-                            ST_Force2D(polygons.polygon)
-                        )::geography
-                    ) AS intersection_area,
-                    polygons.area AS polygon_area,
-                    plateau.area / polygons.area AS area_ratio,
-                    ST_Distance(
-                        ST_Centroid(plateau.geom)::geography,
-                        ST_Centroid(polygons.polygon)::geography) AS dist
-                FROM
-                    "{Plateau.__tablename__}" AS plateau,
-                    polygons
-                WHERE
-                    plateau.geom && polygons.polygon
-                ) s2
-            WHERE
-                intersection_area / polygon_area > 0.4
-                OR intersection_area / area > 0.4
-                OR (
-                    dist < 10.0 AND area_ratio > 0.8 AND area_ratio < 1.2
-                )
-            ORDER BY
-                plateau_bldid ASC,
-                is_overlapped DESC
-            """
-
-        query = self.get_session().execute(sql, {"polygon": polygon})
-
-        results = []
-        for row in query:
-            results.append(dict(row))
+        with self.Session() as session:
+            # 行を dict にコピーせず、キーで参照できる RowMapping のまま返す
+            results = session.execute(
+                _SEARCH_BY_POLYGON,
+                {"polygon": polygon}).mappings().all()
 
         return results
 
         """
         (参考： ORM の場合の記述例，但し面積などは返せない)
-        query = self.get_session().query(Plateau).filter(
+        query = session.query(Plateau).filter(
             Plateau.geom.intersects(polygon),
             (func.ST_Area(
                 cast(func.ST_Intersection(
@@ -416,26 +671,13 @@ class Database(object):
         ----
         マッチングの条件は以下の通り。
         - Plateau ポリゴンと検索ポリゴンの BDR が交差する
+        plateau_geom は反時計回りに並べ替えた Polygon の WKB。
         """
-        sql = f"""
-            SELECT
-                plateau.fid AS plateau_fid,
-                plateau.bldid AS plateau_bldid,
-                plateau.area AS plateau_area,
-                ST_AsGeoJSON(plateau.geom) AS plateau_geom
-            FROM
-                "{Plateau.__tablename__}" AS plateau
-            WHERE
-                plateau.geom && ST_Transform(ST_GeomFromEWKT(:polygon), 4326)
-            ORDER BY
-                plateau_bldid ASC
-            """
-
-        query = self.get_session().execute(sql, {"polygon": polygon})
-
-        results = []
-        for row in query:
-            results.append(dict(row))
+        with self.Session() as session:
+            # 行を dict にコピーせず、キーで参照できる RowMapping のまま返す
+            results = session.execute(
+                _SEARCH_PLATEAU_INTERSECTS_POLYGON,
+                {"polygon": polygon}).mappings().all()
 
         return results
 
@@ -460,10 +702,9 @@ class Database(object):
         # マッチング結果を FeatureCollection に変換
         features = []
         for r in results:
-            # GeoJSON 表現の Polygon を読み込み
-            # 頂点座標列を反時計回りに並べ替え
-            polygon = shapely.geometry.shape(json.loads(r["plateau_geom"]))
-            polygon = shapely.geometry.polygon.orient(polygon, sign=1.0)
+            # WKB 表現の Polygon を読み込み
+            # 頂点座標列は DB 側で反時計回りに並べ替え済み
+            polygon = shapely.wkb.loads(bytes(r["plateau_geom"]))
 
             # Feature を生成
             feature = {
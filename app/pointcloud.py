@@ -1,4 +1,5 @@
 import logging
+import math
 import os
 from typing import List
 
@@ -24,9 +25,16 @@ def read_lasfiles(
     lasfiles: List[PathLike]
         Name of target LAS files.
 
+    Returns
+    -------
+    Tuple[numpy.ndarray, numpy.ndarray] or None
+        (N, 3) float64 array of x, y, z and (N, 4) float32 array of
+        intensity, red, green, blue. None if no points are found.
+
     see: https://laspy.readthedocs.io/en/latest/examples.html
     """
-    point_stack = None
+    xyz_chunks = []
+    attr_chunks = []
     for filename in lasfiles:
         if not os.path.exists(filename):
             logger.warning(
@@ -36,31 +44,110 @@ def read_lasfiles(
             logger.debug("Reading '{}'".format(filename))
 
         with laspy.open(filename) as f:
-            # scale: f.header.scale, offset: f.header.offset
+            # Convert the boundary into the raw integer coordinates
+            # (x = X * scale + offset) so that the mask can be computed
+            # without scaling every point.
+            scales = f.header.scales
+            offsets = f.header.offsets
+            int32 = np.iinfo(np.int32)
+            bx0, by0, bx1, by1 = np.clip([
+                math.ceil((boundary[0] - offsets[0]) / scales[0]),
+                math.ceil((boundary[1] - offsets[1]) / scales[1]),
+                math.floor((boundary[2] - offsets[0]) / scales[0]),
+                math.floor((boundary[3] - offsets[1]) / scales[1]),
+            ], int32.min, int32.max).astype(np.int32)
+
             for points in f.chunk_iterator(10000):
-                x, y = points.x.copy(), points.y.copy()  # For performance
-                mask = (x >= boundary[0]) & (x <= boundary[2]) & \
-                    (y >= boundary[1]) & (y <= boundary[3])
+                X, Y = points.X, points.Y
+                mask = (X >= bx0) & (X <= bx1) & (Y >= by0) & (Y <= by1)
 
-                if not np.any(mask):
+                n = np.count_nonzero(mask)
+                if n == 0:
                     continue
 
-                new_array = np.stack((
-                    x[mask],
-                    y[mask],
-                    points.z.copy()[mask],
-                    points.intensity.copy()[mask],
-                    points.red.copy()[mask] / 65536.0,
-                    points.green.copy()[mask] / 65536.0,
-                    points.blue.copy()[mask] / 65536.0),
-                    axis=-1)
+                # Fill the columns of preallocated arrays in place.
+                # Coordinates are kept in float64 since they are
+                # absolute values in the plane rectangular CS.
+                xyz = np.empty((n, 3), dtype=np.float64)
+                xyz[:, 0] = X[mask]
+                xyz[:, 1] = Y[mask]
+                xyz[:, 2] = points.Z[mask]
+                xyz *= scales
+                xyz += offsets
+                attrs = np.empty((n, 4), dtype=np.float32)
+                attrs[:, 0] = points.intensity[mask]
+                attrs[:, 1] = points.red[mask]
+                attrs[:, 2] = points.green[mask]
+                attrs[:, 3] = points.blue[mask]
+                attrs[:, 1:4] /= np.float32(65536.0)
+
+                xyz_chunks.append(xyz)
+                attr_chunks.append(attrs)
+
+    # Concatenate all chunks at once to avoid repeated reallocation
+    if len(xyz_chunks) == 0:
+        return None
+
+    return np.concatenate(xyz_chunks), np.concatenate(attr_chunks)
+
+
+def voxel_down_sample(points: np.ndarray, voxel_size: float) -> np.ndarray:
+    """
+    三次元点群をボクセルグリッドでダウンサンプリングする。
 
-                if point_stack is None:
-                    point_stack = new_array.copy()
-                else:
-                    point_stack = np.concatenate((point_stack, new_array))
+    Parameters
+    ----------
+    points: numpy.ndarray
+        (N, 3) の点群座標
+    voxel_size: float
+        ボクセルの一辺の長さ
 
-    return point_stack
+    Returns
+    -------
+    numpy.ndarray
+        ボクセルごとに含まれる点の重心を並べた (M, 3) の配列
+
+    Notes
+    -----
+    Open3D の PointCloud.voxel_down_sample() と同じく、
+    最小座標から voxel_size / 2 だけずらした位置をグリッドの原点とする。
+    (N, 3) の一時配列は作らず、ボクセルの番号は 1 列ずつ計算する。
+    作業領域として、点数分の float64 配列 1 つと、キーと並べ替えの
+    添字の int64 配列（並べ替え時は 3 つ）を使う。
+    """
+    npoints = len(points)
+    if npoints == 0:
+        return np.empty((0, 3), dtype=np.float64)
+
+    # 各点が含まれるボクセルの番号を 1 つの整数キーにまとめる
+    # 列ごとに作業用配列で番号を計算し、確保済みのキー配列に加算する
+    origin = points.min(axis=0) - voxel_size * 0.5
+    dims = np.floor(
+        (points.max(axis=0) - origin) / voxel_size).astype(np.int64) + 1
+    keys = np.zeros(npoints, dtype=np.int64)
+    work = np.empty(npoints, dtype=np.float64)
+    for i in range(3):
+        np.subtract(points[:, i], origin[i], out=work)
+        np.divide(work, voxel_size, out=work)
+        np.floor(work, out=work)
+        keys *= dims[i]
+        np.add(keys, work, out=keys, casting='unsafe')
+
+    del work
+
+    # キーの順に並べ、同じキーが連続する区間ごとに座標の平均を計算
+    order = np.argsort(keys)
+    keys = keys[order]
+    starts = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+    del keys
+    starts = np.concatenate(([0], starts))
+    counts = np.diff(np.append(starts, npoints))
+    down = np.empty((len(starts), 3), dtype=np.float64)
+    for i in range(3):
+        down[:, i] = np.add.reduceat(points[order, i], starts)
+        down[:, i] /= counts
+
+    return down
 
 
 def crop_point_cloud(pcd, building, buffer_size=1.0):
@@ -91,9 +178,9 @@ def crop_point_cloud(pcd, building, buffer_size=1.0):
     select_vol.orthogonal_axis = "z"
     select_vol.axis_min = 0
     select_vol.axis_max = 100
-    bldg_ext_pts = list(boundary.exterior.coords)
-    polygon = np.array(bldg_ext_pts, dtype=np.float64)
-    polygon = np.insert(polygon, 2, 0, axis=1)
+    coords = np.asarray(boundary.exterior.coords, dtype=np.float64)
+    polygon = np.zeros((len(coords), 3), dtype=np.float64)
+    polygon[:, 0:2] = coords[:, 0:2]
     logger.debug(polygon)
     select_vol.bounding_polygon = o3d.utility.Vector3dVector(polygon)
 
@@ -122,24 +209,24 @@ def crop_las(
     """
     # 三次元点群のOpen3Dへの読み込み
     # https://github.com/colspan/lasto3dtiles
-    las_array = read_lasfiles(boundary, lasfiles)
-    if las_array is None:
+    las_data = read_lasfiles(boundary, lasfiles)
+    if las_data is None:
         logger.warning("LAS データが存在しませんでした。")
         return o3d.geometry.PointCloud()
         # raise RuntimeError("No LAS data in this server.")
 
+    xyz, attrs = las_data
     logger.info("LAS データを ndarray に読み込み完了 ({})".format(
-        las_array.shape[0]))
+        xyz.shape[0]))
 
     pcd = o3d.geometry.PointCloud()  # CRS is equal to LAS file
-    pcd.points = o3d.utility.Vector3dVector(las_array[:, 0:3])
+    pcd.points = o3d.utility.Vector3dVector(xyz)
     # detect color schema
-    if np.sum(las_array[0, 4:7]) > 0:
-        colors = las_array[:, 4:7]
+    if np.sum(attrs[0, 1:4]) > 0:
+        colors = attrs[:, 1:4]
     else:
-        colors = np.ndarray((las_array.shape[0], 3), dtype=np.float32)
-        for i in range(3):
-            colors[:, i] = las_array[:, 3]
+        # 輝度を 3 チャンネルに展開する（コピーは作らない）
+        colors = np.broadcast_to(attrs[:, 0:1], (attrs.shape[0], 3))
     pcd.colors = o3d.utility.Vector3dVector(colors)
 
     logger.info("三次元点群をOpen3Dに読み込み完了")
@@ -3,12 +3,65 @@
 https://www.mlit.go.jp/common/001248461.pdf
 """
 
+import functools
 from logging import getLogger
 from typing import List, Optional, Tuple
-import re
+
+import numpy as np
 
 logger = getLogger(__name__)
 
+_DIGITS = '0123456789'
+_ALPHABETS = 'ABCDEFGHIJKLMNOPQRST'
+
+
+def _build_subdivisions():
+    """
+    区画を細分する文字列から (分割数, 行, 列) を引くテーブルを作る。
+    """
+    table = {}
+    # 同三 および 独自拡張 2分割
+    for i, c in enumerate('1234'):
+        table[c] = (2, i // 2, i % 2)
+
+    for row, r in enumerate(_DIGITS):
+        # 同四 および 独自拡張 5分割
+        for col, c in enumerate(_ALPHABETS[:5]):
+            table[r + c] = (5, row, col)
+
+        # 同二・同五 および 独自拡張 10分割
+        for col, c in enumerate(_DIGITS):
+            table[r + c] = (10, row, col)
+
+    # 同六 および 独自拡張 20分割
+    for row, r in enumerate(_ALPHABETS):
+        for col, c in enumerate(_ALPHABETS):
+            table[r + c] = (20, row, col)
+
+    return table
+
+
+_SUBDIVISIONS = _build_subdivisions()
+
+# 数値部分の長さごとの、細分に使う文字列の位置
+_SPLITS = (
+    (),
+    (),
+    ((0, 2),),
+    ((0, 2), (2, 3)),
+    ((0, 2), (2, 4)),
+    ((0, 2), (2, 4), (4, 5)),
+    ((0, 2), (2, 4), (4, 6)),
+)
+
+
+def _divide(value, n):
+    # 割り切れる場合は整数のまま分割する
+    if value % n == 0:
+        return value // n
+
+    return value / n
+
 
 def get_extent(code: str) -> Tuple[int, int, int, int, str, int]:
     """
@@ -25,90 +78,35 @@ def get_extent(code: str) -> Tuple[int, int, int, int, str, int]:
     tuple(min_x, min_y, max_x, max_y, crs, int)
         区画の北西端と南東端の座標, CRS, 地図情報レベル
     """
-    m = re.match(r'([0-9]{2})?([A-Z]{2})([0-9A-T]*)', code)
-    system_code, kukaku, numbers = m.groups()
+    if code[:2].isdecimal():
+        system_code, kukaku, numbers = code[:2], code[2:4], code[4:]
+    else:
+        system_code, kukaku, numbers = None, code[:2], code[2:]
+
     logger.debug("系:{}, 区画:{}, 数値:{}".format(system_code, kukaku, numbers))
 
     # 第84条4の一
-    x0 = (-160 + (ord(kukaku[1]) - 65) * 40) * 1000
-    y0 = (300 - (ord(kukaku[0]) - 65) * 30) * 1000
+    x0 = (-160 + _ALPHABETS.index(kukaku[1]) * 40) * 1000
+    y0 = (300 - _ALPHABETS.index(kukaku[0]) * 30) * 1000
     dx, dy = 40000, 30000
     level = 50000
 
-    if len(numbers) >= 2:
-        # 同二 地図情報レベル5000
-        x0 += (ord(numbers[1]) - 48) * 4000
-        y0 -= (ord(numbers[0]) - 48) * 3000
-        dx, dy = 4000, 3000
-        level = 5000
+    # 同二から同六、および独自拡張の分割を先頭から順に適用する
+    if len(numbers) < len(_SPLITS):
+        splits = _SPLITS[len(numbers)]
+    else:
+        splits = _SPLITS[4]
 
-    if len(numbers) == 3:
-        # 同三 地図情報レベル2500
-        if numbers[2] in ('2', '4'):
-            x0 += 2000
-
-        if numbers[2] in ('3', '4'):
-            y0 -= 1500
-
-        dx, dy = 2000, 1500
-        level = 2500
-
-    if len(numbers) >= 4:
-        if ord(numbers[2]) >= 48 and ord(numbers[2]) < 58:  # 0-9
-            if ord(numbers[3]) >= 65 and ord(numbers[3]) < 70:  # A-E
-                # 同四 地図情報レベル1000
-                x0 += (ord(numbers[3]) - 65) * 800
-                y0 -= (ord(numbers[2]) - 48) * 600
-                dx, dy = 800, 600
-                level = 1000
-
-            elif ord(numbers[3]) >= 48 and ord(numbers[3]) < 58:
-                # 同五 地図情報レベル500
-                x0 += (ord(numbers[3]) - 48) * 400
-                y0 -= (ord(numbers[2]) - 48) * 300
-                dx, dy = 400, 300
-                level = 500
-
-        elif ord(numbers[2]) >= 65 and ord(numbers[2]) < 85:  # A-T
-            # 同六 地図情報レベル250
-            x0 += (ord(numbers[3]) - 65) * 200
-            y0 -= (ord(numbers[2]) - 65) * 150
-            dx, dy = 200, 150
-            level = 250
-
-    if len(numbers) == 5:
-        # 独自拡張 2分割
-        dx, dy = dx / 2, dy / 2
-        if ord(numbers[4]) in ('2', '4'):
-            x0 += dx
-
-        if ord(numbers[4]) in ('3', '4'):
-            y0 -= dy
-
-        level /= 2
-
-    if len(numbers) == 6:
-        if ord(numbers[4]) >= 48 and ord(numbers[4]) < 58:  # 0-9
-            if ord(numbers[5]) >= 65 and ord(numbers[5]) < 70:  # A-E
-                # 独自拡張 5分割
-                dx, dy = dx / 5, dy / 5
-                x0 += (ord(numbers[5]) - 65) * dx
-                y0 -= (ord(numbers[4]) - 48) * dy
-                level /= 5
-
-            elif ord(numbers[5]) >= 48 and ord(numbers[5]) < 58:  # 0-9
-                # 独自拡張 10分割
-                dx, dy = dx / 10, dy / 10
-                x0 += (ord(numbers[5]) - 48) * dx
-                y0 -= (ord(numbers[4]) - 48) * dy
-                level /= 10
-
-        elif ord(numbers[4]) >= 65 and ord(numbers[4]) < 85:  # A-T
-            # 独自拡張 20分割
-            dx, dy = dx / 20, dy / 20
-            x0 += (ord(numbers[5]) - 65) * dx
-            y0 -= (ord(numbers[4]) - 65) * dy
-            level /= 20
+    for start, end in splits:
+        subdivision = _SUBDIVISIONS.get(numbers[start:end])
+        if subdivision is None:
+            continue
+
+        n, row, col = subdivision
+        dx, dy = _divide(dx, n), _divide(dy, n)
+        x0 += col * dx
+        y0 -= row * dy
+        level = _divide(level, n)
 
     if system_code:
         crs = 'EPSG:{:4d}'.format(6668 + int(system_code))
@@ -118,6 +116,18 @@ def get_extent(code: str) -> Tuple[int, int, int, int, str, int]:
     return (x0, y0 - dy, x0 + dx, y0, crs, level)
 
 
+@functools.lru_cache(maxsize=32)
+def _get_transformer(crs: str):
+    """
+    指定された CRS から WGS84 に変換する Transformer を返す。
+    生成に時間がかかるため、 CRS ごとにキャッシュしておく。
+    """
+    import pyproj
+
+    return pyproj.Transformer.from_crs(
+        pyproj.CRS(crs), pyproj.CRS('EPSG:4326'), always_xy=True)
+
+
 def get_extent_polygon(meshcode: str):
     """
     指定された区画を表す Shaply Polygon を返す。
@@ -132,22 +142,19 @@ def get_extent_polygon(meshcode: str):
     shapely.geometry.Polygon
         WGS84 に変換したポリゴン
     """
-    import pyproj
     import shapely.geometry
 
     x0, y0, x1, y1, crs, level = get_extent(meshcode)
 
-    from_crs = pyproj.CRS(crs)
-    wgs84 = pyproj.CRS('EPSG:4326')
-    transformer = pyproj.Transformer.from_crs(from_crs, wgs84, always_xy=True)
+    transformer = _get_transformer(crs)
 
     lon0, lat0 = transformer.transform(x0, y0)
     lon1, lat1 = transformer.transform(x1, y1)
 
+    # x0 < x1, y0 < y1 なので、頂点を反時計回りに並べて作成する
     polygon = shapely.geometry.Polygon([
-        [lon0, lat0], [lon0, lat1],
-        [lon1, lat1], [lon1, lat0], [lon0, lat0]])
-    polygon = shapely.geometry.polygon.orient(polygon, sign=1.0)
+        [lon0, lat0], [lon1, lat0],
+        [lon1, lat1], [lon0, lat1], [lon0, lat0]])
     return polygon
 
 
@@ -185,14 +192,14 @@ def get_code(
     y = int(-y)
 
     # 第84条4の一：区画名
-    code += chr(75 + y // 30000) + chr(69 + x // 40000)  # [A-T][A-H]
+    code += _ALPHABETS[10 + y // 30000] + _ALPHABETS[4 + x // 40000]
     if level > 5000:
         return code
 
     # 同二 地図情報レベル5000
     x %= 40000
     y %= 30000
-    code += chr(48 + y // 3000) + chr(48 + x // 4000)  # [0-9][0-9]
+    code += _DIGITS[y // 3000] + _DIGITS[x // 4000]
     if level > 2500:
         return code
 
@@ -201,31 +208,22 @@ def get_code(
 
     if level == 2500:
         # 同三 地図情報レベル2500
-        if x < 2000.0:
-            if y < 1500.0:
-                code += '1'
-            else:
-                code += '3'
-        else:
-            if y < 1500.0:
-                code += '2'
-            else:
-                code += '4'
+        code += '1234'[(y >= 1500) * 2 + (x >= 2000)]
 
         return code
 
     if level == 1000:
         # 同四 地図情報レベル1000
-        code += chr(548 + y // 600) + chr(65 + x // 800)  # [0-4][A-E]
+        code += _DIGITS[y // 600] + _ALPHABETS[x // 800]
         return code
 
     if level == 250:
         # 同六 地図情報レベル250
-        code += chr(65 + y // 150) + chr(65 + x // 200)  # [A-T][A-T]
+        code += _ALPHABETS[y // 150] + _ALPHABETS[x // 200]
         return code
 
     # 同五 地図情報レベル500
-    code += chr(48 + y // 300) + chr(48 + x // 400)  # [0-9][0-9]
+    code += _DIGITS[y // 300] + _DIGITS[x // 400]
     if level == 500:
         return code
 
@@ -234,13 +232,90 @@ def get_code(
 
     if level == 50:
         # 独自拡張 地図情報レベル500 をさらに各辺10等分
-        code += chr(48 + y // 30) + chr(48 + x // 40)  # [0-9][0-9]
+        code += _DIGITS[y // 30] + _DIGITS[x // 40]
         return code
 
     raise ValueError(
         "Unkown level, supported levels are: 5000,2500,1000,500,250,50")
 
 
+def _get_codes(
+        x: np.ndarray, y: np.ndarray,
+        system_code: Optional[int] = None,
+        level: int = 5000) -> List[str]:
+    """
+    get_code() を座標の配列に対してまとめて適用する。
+
+    Parameter
+    ---------
+    x, y: numpy.ndarray
+        X および Y 座標の配列
+    system_code: int
+        系番号, 省略した場合は先頭二文字が省略される
+    level: int
+        地図情報レベル，省略した場合は 5000
+
+    Returns
+    -------
+    List[string]
+        図郭番号のリスト
+    """
+    if np.any(np.abs(x) >= 160000) or np.any(np.abs(y) >= 300000):
+        raise ValueError("X and/or Y values are out of range.")
+
+    digits = np.frombuffer(_DIGITS.encode(), dtype=np.uint8)
+    alphabets = np.frombuffer(_ALPHABETS.encode(), dtype=np.uint8)
+
+    columns = []
+    if system_code:
+        # 系
+        for c in '{:02d}'.format(system_code).encode():
+            columns.append(np.full(len(x), c, dtype=np.uint8))
+
+    # 「0を含むマイナス値」の境界判定を避けるため、yの値を反転しておく
+    x = np.trunc(x).astype(np.int64)
+    y = np.trunc(-y).astype(np.int64)
+
+    # 第84条4の一：区画名
+    columns += [alphabets[10 + y // 30000], alphabets[4 + x // 40000]]
+    if level <= 5000:
+        # 同二 地図情報レベル5000
+        x %= 40000
+        y %= 30000
+        columns += [digits[y // 3000], digits[x // 4000]]
+
+    if level <= 2500:
+        x %= 4000
+        y %= 3000
+
+        if level == 2500:
+            # 同三 地図情報レベル2500
+            columns.append(digits[1 + (y >= 1500) * 2 + (x >= 2000)])
+        elif level == 1000:
+            # 同四 地図情報レベル1000
+            columns += [digits[y // 600], alphabets[x // 800]]
+        elif level == 250:
+            # 同六 地図情報レベル250
+            columns += [alphabets[y // 150], alphabets[x // 200]]
+        elif level in (500, 50):
+            # 同五 地図情報レベル500
+            columns += [digits[y // 300], digits[x // 400]]
+            if level == 50:
+                # 独自拡張 地図情報レベル500 をさらに各辺10等分
+                x %= 400
+                y %= 300
+                columns += [digits[y // 30], digits[x // 40]]
+        else:
+            raise ValueError(
+                "Unkown level, supported levels are: "
+                "5000,2500,1000,500,250,50")
+
+    # 1 文字ずつの列を並べ、行ごとに 1 つのバイト列として読み出す
+    chars = np.ascontiguousarray(np.stack(columns, axis=1))
+    codes = chars.view('S{}'.format(chars.shape[1])).ravel()
+    return codes.astype(str).tolist()
+
+
 def get_codes_in_area(
         x0: float, y0: float, x1: float, y1: float,
         system_code: Optional[int] = None,
@@ -266,30 +341,24 @@ def get_codes_in_area(
         raise ValueError(
             "Unkown level, supported levels are: 5000,2500,1000,500,250,50")
 
-    dx, dy = (40000 * level / 50000, 30000 * level / 50000)
+    dx, dy = (40000 * level // 50000, 30000 * level // 50000)
     if x0 > x1:
         x0, x1 = x1, x0
 
     if y0 > y1:
         y0, y1 = y1, y0
 
-    codes = []
-    x, y = x0, y0
-    while True:
-        while True:
-            codes.append(get_code(x, y, system_code=system_code, level=level))
-            if y > y1:
-                break
-
-            y += dy
-
-        if x > x1:
-            break
+    # 走査する X, Y 座標の列（範囲を 1 区画越えるところまで）
+    xs, ys = [x0], [y0]
+    while xs[-1] <= x1:
+        xs.append(xs[-1] + dx)
 
-        x += dx
-        y = y0
+    while ys[-1] <= y1:
+        ys.append(ys[-1] + dy)
 
-    return codes
+    x, y = np.meshgrid(xs, ys, indexing='ij')
+    return _get_codes(
+        x.ravel(), y.ravel(), system_code=system_code, level=level)
 
 
 if __name__ == '__main__':
@@ -42,7 +42,10 @@ CREATE TABLE public.plateau_buildings (
   bldid text,
   geom geometry(Polygon,4326),
   geom3d geometry(MultiPolygonZ,4326),
-  area double precision
+  area double precision,
+  -- 距離計算用に 2D ポリゴンの重心を保持しておく
+  centroid_geog geography(Point,4326)
+    GENERATED ALWAYS AS (ST_Centroid(geom)::geography) STORED
 );
 
 -- WebAPI 用のテーブルに 2D と 3D のジオメトリを格納する
@@ -70,7 +73,7 @@ RENAME TO plateau_buildings_lod1;
 
 CREATE INDEX idx_plateau_buildings_lod1_geom
 ON plateau_buildings_lod1
-USING gist(geom);
+USING spgist(geom);
 
 --
 -- LoD2
@@ -108,7 +111,10 @@ CREATE TABLE public.plateau_buildings (
   bldid text,
   geom geometry(Polygon,4326),
   geom3d geometry(MultiPolygonZ,4326),
-  area double precision
+  area double precision,
+  -- 距離計算用に 2D ポリゴンの重心を保持しておく
+  centroid_geog geography(Point,4326)
+    GENERATED ALWAYS AS (ST_Centroid(geom)::geography) STORED
 );
 
 -- WebAPI 用のテーブルに 2D と 3D のジオメトリを格納する
@@ -135,4 +141,4 @@ ALTER TABLE plateau_buildings
 RENAME TO plateau_buildings_lod2;
 CREATE INDEX idx_plateau_buildings_lod2_geom
 ON plateau_buildings_lod2
-USING gist(geom);
+USING spgist(geom);
@@ -0,0 +1,32 @@
+#!/bin/bash
+set -e
+
+# restoredb.sh でリストアしたテーブルを更新する
+psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "$POSTGRES_DB" <<-EOSQL
+	-- 隣接する建物ポリゴンは外接矩形が重なるため、
+	-- geom のインデックスを GiST から SP-GiST に張り替える
+	-- (pgdb-20221107.dump.gz のインデックス名は _geom なし)
+	DROP INDEX IF EXISTS idx_plateau_buildings_lod1;
+	DROP INDEX IF EXISTS idx_plateau_buildings_lod1_geom;
+	CREATE INDEX idx_plateau_buildings_lod1_geom
+	ON plateau_buildings_lod1
+	USING spgist(geom);
+
+	DROP INDEX IF EXISTS idx_plateau_buildings_lod2;
+	DROP INDEX IF EXISTS idx_plateau_buildings_lod2_geom;
+	CREATE INDEX idx_plateau_buildings_lod2_geom
+	ON plateau_buildings_lod2
+	USING spgist(geom);
+
+	-- 距離計算用に 2D ポリゴンの重心を保持しておく
+	ALTER TABLE plateau_buildings_lod1
+	ADD COLUMN IF NOT EXISTS centroid_geog geography(Point,4326)
+	GENERATED ALWAYS AS (ST_Centroid(geom)::geography) STORED;
+
+	ALTER TABLE plateau_buildings_lod2
+	ADD COLUMN IF NOT EXISTS centroid_geog geography(Point,4326)
+	GENERATED ALWAYS AS (ST_Centroid(geom)::geography) STORED;
+
+	ANALYZE plateau_buildings_lod1;
+	ANALYZE plateau_buildings_lod2;
+EOSQL